@@ -0,0 +1,40 @@
+# example cmd, profile all backends on CPU:
+# python benchmark_augmentations.py --bs "32,128" --sizes "96,224" --n-iter 5
+
+from fastai.vision.all import *
+from self_supervised.augmentations import *
+from self_supervised.benchmark import *
+
+
+@call_parse
+def main(
+    backends:   Param("Comma separated backends to profile", str)='default,kornia,torchvision,fastai,affine',
+    bs:         Param("Comma separated batch sizes", str)='32,128',
+    sizes:      Param("Comma separated output resolutions", str)='96,224',
+    n_iter:     Param("Number of profiled calls per setting", int)=5,
+    n_views:    Param("Number of views, e.g. 2 for SimCLR", int)=2,
+    device:     Param("Device to run augmentations on", str)='cpu',
+    out:        Param("Optional csv file to save the results to", str)=None):
+
+    results = []
+    for backend in backends.split(','):
+        for b in map(int, bs.split(',')):
+            for size in map(int, sizes.split(',')):
+                # source images are larger than the crops as after a RandomResizedCrop item transform
+                x = TensorImage(torch.rand(b, 3, int(size*1.15), int(size*1.15), device=device))
+                profiler = AugProfiler(device)
+                augs = profiler.wrap([batch_aug_backends[backend](size, cuda=device!='cpu') for _ in range(n_views)], backend)
+                for aug in augs: aug(x) # warmup
+                profiler.reset()
+                for _ in range(n_iter): [aug(x) for aug in augs]
+                df = profiler.table(per_view=False)
+                df.insert(1, 'size', size); df.insert(1, 'bs', b)
+                results.append(df)
+
+    df = pd.concat(results, ignore_index=True)
+    with pd.option_context('display.max_rows', None, 'display.width', 200, 'display.precision', 2):
+        for backend, d in df.groupby('backend', sort=False):
+            print(f"\n{backend}: total ms per batch for {n_views} views")
+            print(d.groupby(['bs','size']).total_ms.sum().div(n_iter).to_string())
+            print(d.drop(columns='backend').to_string(index=False))
+    if out is not None: df.to_csv(out, index=False)
@@ -0,0 +1,77 @@
+# example cmd, weak scaling of DistributedMOCO on 1, 2 and 4 CPU processes with gloo:
+# python benchmark_distributed_moco.py --world-sizes "1,2,4" --bs 32 --n-iter 10
+
+import time
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from fastai.vision.all import *
+from self_supervised.layers import *
+from self_supervised.vision.moco import *
+
+
+class GlooDDP(Callback):
+    "Wrap model in `DistributedDataParallel` on CPU, `fastai.distributed.DistributedTrainer` targets GPUs"
+    order = 11
+    def before_fit(self): self.learn.model = DistributedDataParallel(self.model)
+    def after_fit(self):  self.learn.model = self.model.module
+
+
+class StepTimer(Callback):
+    "Wall time of training steps after `n_warmup` steps"
+    order = 100
+    def __init__(self, n_warmup=2): self.n_warmup, self.times = n_warmup, []
+    def before_batch(self):
+        if self.training: self.start = time.perf_counter()
+    def after_step(self):
+        if self.iter >= self.n_warmup: self.times.append(time.perf_counter()-self.start)
+
+
+def _synthetic_dls(n, bs, size, seed):
+    "Each process trains on its own random images, as a `DistributedDL` shard would"
+    g = torch.Generator().manual_seed(seed)
+    x, y = torch.rand(n, 3, size, size, generator=g), torch.zeros(n, dtype=torch.long)
+    dsets = [[(TensorImage(x[i]), TensorCategory(y[i])) for i in range(n)] for _ in range(2)]
+    return DataLoaders.from_dsets(*dsets, bs=bs, device='cpu', drop_last=True)
+
+
+def _worker(rank, world_size, port, arch, bs, size, K, n_iter, results):
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port), RANK=str(rank), WORLD_SIZE=str(world_size))
+    torch.set_num_threads(1)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    try:
+        dls = _synthetic_dls(bs*(n_iter+2), bs, size, seed=rank)
+        model = create_moco_model(create_encoder(arch, pretrained=False), hidden_size=256, projection_size=128, bn=True)
+        aug_pipelines = get_moco_aug_pipelines(size, cuda=False)
+        timer = StepTimer()
+        learn = Learner(dls, model, loss_func=noop, cbs=[DistributedMOCO(aug_pipelines, K=K), GlooDDP(), timer])
+        with learn.no_bar(), learn.no_logging(): learn.fit(1)
+        step = torch.tensor(np.mean(timer.times))
+        dist.all_reduce(step, op=dist.ReduceOp.MAX)
+        # all processes hold the same queue with keys of the global batch
+        ptr = learn.model.queue.ptr.clone(); dist.broadcast(ptr, src=0)
+        assert ptr == learn.model.queue.ptr == (world_size*bs*(n_iter+2)) % K
+        if rank == 0: results[world_size] = step.item()
+    finally: dist.destroy_process_group()
+
+
+@call_parse
+def main(
+    world_sizes: Param("Comma separated number of processes", str)='1,2,4',
+    arch:        Param("timm encoder", str)='resnet10t',
+    bs:          Param("Batch size per process", int)=32,
+    size:        Param("Image size", int)=64,
+    K:           Param("Queue size", int)=4096,
+    n_iter:      Param("Number of timed training steps", int)=10,
+    port:        Param("Rendezvous port", int)=29531):
+
+    results = mp.Manager().dict()
+    for ws in map(int, world_sizes.split(',')):
+        mp.spawn(_worker, args=(ws, port+ws, arch, bs, size, K, n_iter, results), nprocs=ws, join=True)
+
+    base = bs/results[1] if 1 in results else None
+    print(f"DistributedMOCO on gloo, {arch}, bs={bs} per process, size={size}, {os.cpu_count()} cpus")
+    for ws, step in sorted(results.items()):
+        throughput = ws*bs/step
+        eff = f"{throughput/(ws*base):.2f}" if base is not None else "-"
+        print(f"world_size={ws}: {step*1000:.0f} ms/step, {throughput:.1f} img/s, scaling efficiency {eff}")
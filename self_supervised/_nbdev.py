@@ -2,11 +2,21 @@
 
 __all__ = ["index", "modules", "custom_doc_links", "git_url"]
 
-index = {"RandomGaussianBlur": "01 - augmentations.ipynb",
+index = {"gaussian_kernel1d": "01 - augmentations.ipynb",
+         "batch_gaussian_blur": "01 - augmentations.ipynb",
+         "RandomGaussianBlur": "01 - augmentations.ipynb",
          "get_kornia_batch_augs": "01 - augmentations.ipynb",
          "get_torchvision_batch_augs": "01 - augmentations.ipynb",
          "get_fastai_batch_augs": "01 - augmentations.ipynb",
          "get_batch_augs": "01 - augmentations.ipynb",
+         "sample_crop_boxes": "01 - augmentations.ipynb",
+         "crop_flip_rotate_theta": "01 - augmentations.ipynb",
+         "random_resized_crop_affine": "01 - augmentations.ipynb",
+         "RandomResizedCropAffine": "01 - augmentations.ipynb",
+         "color_jitter_matrices": "01 - augmentations.ipynb",
+         "RandomColorAffine": "01 - augmentations.ipynb",
+         "get_affine_batch_augs": "01 - augmentations.ipynb",
+         "MultiViewAugmentation": "01 - augmentations.ipynb",
          "get_multi_aug_pipelines": "01 - augmentations.ipynb",
          "assert_aug_pipelines": "01 - augmentations.ipynb",
          "create_fastai_encoder": "02 - layers.ipynb",
@@ -45,19 +55,19 @@ index = {"RandomGaussianBlur": "01 - augmentations.ipynb",
          "get_dino_aug_pipelines": "15 - dino.ipynb",
          "DINOModel": "15 - dino.ipynb",
          "DINO": "15 - dino.ipynb",
-         "ClipTokenizer": "21 - clip-moco.ipynb",
-         "vitb32_config": "21 - clip-moco.ipynb",
-         "vitl14_config": "21 - clip-moco.ipynb",
-         "Bottleneck": "21 - clip-moco.ipynb",
-         "AttentionPool2d": "21 - clip-moco.ipynb",
-         "ModifiedResNet": "21 - clip-moco.ipynb",
-         "LayerNorm": "21 - clip-moco.ipynb",
-         "QuickGELU": "21 - clip-moco.ipynb",
-         "ResidualAttentionBlock": "21 - clip-moco.ipynb",
-         "Transformer": "21 - clip-moco.ipynb",
-         "VisualTransformer": "21 - clip-moco.ipynb",
+         "ClipTokenizer": "20 - clip.ipynb",
+         "vitb32_config": "20 - clip.ipynb",
+         "vitl14_config": "20 - clip.ipynb",
+         "Bottleneck": "20 - clip.ipynb",
+         "AttentionPool2d": "20 - clip.ipynb",
+         "ModifiedResNet": "20 - clip.ipynb",
+         "LayerNorm": "20 - clip.ipynb",
+         "QuickGELU": "20 - clip.ipynb",
+         "ResidualAttentionBlock": "20 - clip.ipynb",
+         "Transformer": "20 - clip.ipynb",
+         "VisualTransformer": "20 - clip.ipynb",
          "CLIP": "20 - clip.ipynb",
-         "RetrievalAtK": "21 - clip-moco.ipynb",
+         "RetrievalAtK": "20 - clip.ipynb",
          "CLIPTrainer": "20 - clip.ipynb",
          "DistributedCLIPTrainer": "20 - clip.ipynb",
          "CLIPMOCO": "21 - clip-moco.ipynb",
@@ -75,7 +85,39 @@ index = {"RandomGaussianBlur": "01 - augmentations.ipynb",
          "deit_tiny": "90 - models.vision_transformer.ipynb",
          "deit_small": "90 - models.vision_transformer.ipynb",
          "vit_base": "90 - models.vision_transformer.ipynb",
-         "but": "90 - models.vision_transformer.ipynb"}
+         "but": "90 - models.vision_transformer.ipynb",
+         "flatten_tensors_": "04 - ema.ipynb",
+         "EMA": "04 - ema.ipynb",
+         "peak_memory": "05 - benchmark.ipynb",
+         "benchmark": "05 - benchmark.ipynb",
+         "nt_xent_loss": "10 - simclr.ipynb",
+         "EmbeddingBank": "70 - vision.metrics.ipynb",
+         "knn_classify": "70 - vision.metrics.ipynb",
+         "MemmapEmbeddingBank": "71 - vision.embeddings.ipynb",
+         "extract_embeddings": "71 - vision.embeddings.ipynb",
+         "AugProfiler": "05 - benchmark.ipynb",
+         "ProfileAugs": "05 - benchmark.ipynb",
+         "split_batchnorm": "02 - layers.ipynb",
+         "sinkhorn_knopp": "13 - swav.ipynb",
+         "concat_all_gather": "03 - distributed.ipynb",
+         "FeatureQueue": "02 - layers.ipynb",
+         "batch_shuffle": "03 - distributed.ipynb",
+         "batch_unshuffle": "03 - distributed.ipynb",
+         "DistributedMOCO": "11 - moco.ipynb",
+         "get_world_size": "03 - distributed.ipynb",
+         "get_rank": "03 - distributed.ipynb",
+         "all_reduce": "03 - distributed.ipynb",
+         "run_gloo": "03 - distributed.ipynb",
+         "DistributedSWAV": "13 - swav.ipynb",
+         "DistributedDINO": "15 - dino.ipynb",
+         "AsyncGather": "03 - distributed.ipynb",
+         "all_gather_with_grad": "03 - distributed.ipynb",
+         "GradCache": "02 - layers.ipynb",
+         "dino_loss": "15 - dino.ipynb",
+         "barlow_twins_loss": "14 - barlow_twins.ipynb",
+         "color_affine": "01 - augmentations.ipynb",
+         "batch_aug_backends": "01 - augmentations.ipynb",
+         "ddp_ignore_queues": "02 - layers.ipynb"}
 
 modules = ["augmentations.py",
            "layers.py",
@@ -89,7 +131,10 @@ modules = ["augmentations.py",
            "multimodal/clip.py",
            "multimodal/clip_moco.py",
            "vision/metrics.py",
-           "models/vision_transformer.py"]
+           "models/vision_transformer.py",
+           "ema.py",
+           "benchmark.py",
+           "vision/embeddings.py"]
 
 doc_url = "https://keremturgutlu.github.io/self_supervised/"
 
@@ -1,7 +1,10 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/01 - augmentations.ipynb (unless otherwise specified).
 
-__all__ = ['RandomGaussianBlur', 'get_kornia_batch_augs', 'get_torchvision_batch_augs', 'get_fastai_batch_augs',
-           'get_batch_augs', 'get_multi_aug_pipelines', 'assert_aug_pipelines']
+__all__ = ['gaussian_kernel1d', 'batch_gaussian_blur', 'RandomGaussianBlur', 'get_kornia_batch_augs',
+           'get_torchvision_batch_augs', 'get_fastai_batch_augs', 'get_batch_augs', 'sample_crop_boxes',
+           'crop_flip_rotate_theta', 'random_resized_crop_affine', 'RandomResizedCropAffine', 'color_jitter_matrices',
+           'color_affine', 'RandomColorAffine', 'get_affine_batch_augs', 'batch_aug_backends', 'MultiViewAugmentation',
+           'get_multi_aug_pipelines', 'assert_aug_pipelines']
 
 # Cell
 from fastai.vision.all import *
@@ -9,21 +12,60 @@ from kornia.augmentation import augmentation as korniatfm
 import torchvision.transforms as tvtfm
 import kornia
 
+# Cell
+def gaussian_kernel1d(ks, sigma):
+    "Normalized 1-D gaussian kernel of size `ks`, same as kornia's `get_gaussian_kernel1d`"
+    x = torch.arange(ks).float() - ks//2
+    if ks % 2 == 0: x = x + 0.5
+    k = torch.exp(-x**2 / (2*sigma**2))
+    return k / k.sum()
+
+
+def batch_gaussian_blur(x, kernels):
+    "Blur each image of `x` with its own separable 1-D kernel from `kernels` (bs, ks) in one grouped convolution"
+    bs, c, h, w = x.shape
+    ks = kernels.size(1)
+    wt = kernels.to(x).repeat_interleave(c, 0)
+    x = F.pad(x.reshape(1, bs*c, h, w), (ks//2, (ks-1)//2, ks//2, (ks-1)//2), mode='reflect')
+    x = F.conv2d(x, wt[:,None,None,:], groups=bs*c)
+    x = F.conv2d(x, wt[:,None,:,None], groups=bs*c)
+    return x.view(bs, c, h, w)
+
 # Cell
 class RandomGaussianBlur(RandTransform):
-    "Randomly apply gaussian blur with probability `p` with a value of s"
+    "Randomly apply gaussian blur with probability `p` with a value of s, sampled per image unless `same_on_batch`"
     order = 11
     def __init__(self, p=0.5, s=(8,32), same_on_batch=False, **kwargs):
         store_attr()
         super().__init__(p=p, **kwargs)
+        # one kernel per possible value of s with the same kernel size and sigma as before, zero padded to the largest
+        # kernel size, so that a batch with different sigmas can be blurred with a single convolution
+        self.sigmas = list(range(*s)) if isinstance(s, (tuple, list)) else [s]
+        kernels = [gaussian_kernel1d(int(s/4)*2+1, s) for s in self.sigmas]
+        ks = max(len(k) for k in kernels)
+        self.kernels = torch.stack([F.pad(k, ((ks-len(k))//2, (ks-len(k))//2)) for k in kernels])
+        self._cache = {}
+
+    def before_call(self, b, split_idx):
+        # `p` is applied per image in `encodes`
+        self.do = True
+
+    def _kernels(self, x):
+        key = (x.device, x.dtype)
+        if key not in self._cache: self._cache[key] = self.kernels.to(x)
+        return self._cache[key]
 
     def encodes(self, x:TensorImage):
-        if isinstance(self.s, tuple): s = np.random.randint(*self.s)
-        if isinstance(self.s, list):  s = np.random.randint(*self.s)
-        if isinstance(self.s, int):   s = self.s
-        s2 = int(s/4)*2+1
-        tfm = korniatfm.GaussianBlur((s2,s2),(s,s),same_on_batch=self.same_on_batch,p=1.)
-        return tfm(x)
+        n = 1 if self.same_on_batch else x.size(0)
+        do = torch.rand(n, device=x.device) < self.p
+        idx = torch.randint(len(self.sigmas), (n,), device=x.device)
+        if self.same_on_batch: do, idx = do.expand(x.size(0)), idx.expand(x.size(0))
+        sel = do.nonzero()[:,0]
+        if len(sel) == 0: return x
+        if len(sel) == x.size(0): return batch_gaussian_blur(x, self._kernels(x)[idx])
+        x = x.clone()
+        x[sel] = batch_gaussian_blur(x[sel], self._kernels(x)[idx[sel]])
+        return x
 
 # Cell
 def get_kornia_batch_augs(size,
@@ -163,9 +205,232 @@ def get_batch_augs(size,
     pipe = Pipeline(tfms, split_idx = 0)
     return pipe
 
+# Cell
+def sample_crop_boxes(n, h, w, scale=(0.08, 1.0), ratio=(3/4, 4/3), device=None, attempts=10):
+    "Vectorized `RandomResizedCrop.get_params`, returns `n` crop boxes as `(x0, y0, crop_w, crop_h)` tensors in pixels"
+    area = h*w
+    target_area = torch.empty(n, attempts, device=device).uniform_(*scale) * area
+    aspect = torch.empty(n, attempts, device=device).uniform_(math.log(ratio[0]), math.log(ratio[1])).exp()
+    cw, ch = (target_area*aspect).sqrt().round(), (target_area/aspect).sqrt().round()
+    valid = (cw > 0) & (cw <= w) & (ch > 0) & (ch <= h)
+    first = valid.int().argmax(1, keepdim=True)
+    cw, ch, ok = cw.gather(1, first)[:,0], ch.gather(1, first)[:,0], valid.any(1)
+
+    # same center crop fallback as torchvision if none of the attempts fit in the image
+    in_ratio = w/h
+    if   in_ratio < min(ratio): fw, fh = w, round(w/min(ratio))
+    elif in_ratio > max(ratio): fw, fh = round(h*max(ratio)), h
+    else:                       fw, fh = w, h
+    cw, ch = torch.where(ok, cw, torch.full_like(cw, fw)), torch.where(ok, ch, torch.full_like(ch, fh))
+    x0 = torch.where(ok, (torch.rand(n, device=device)*(w-cw+1)).floor(), ((w-cw)/2).floor())
+    y0 = torch.where(ok, (torch.rand(n, device=device)*(h-ch+1)).floor(), ((h-ch)/2).floor())
+    return x0, y0, cw, ch
+
+# Cell
+def crop_flip_rotate_theta(x0, y0, cw, ch, h, w, flip=None, angle=None):
+    "`affine_grid` matrices which resample crop boxes of a `h`x`w` image, horizontally flipped and rotated by `angle` degrees"
+    a = torch.zeros_like(x0) if angle is None else angle*math.pi/180
+    f = torch.ones_like(x0)  if flip  is None else 1-2*flip.to(x0.dtype)
+    cos, sin, sx, sy = a.cos(), a.sin(), cw/w, ch/h
+    theta = x0.new_empty(x0.size(0), 2, 3)
+    theta[:,0,0], theta[:,0,1], theta[:,0,2] = sx*f*cos, -sx*f*sin, (2*x0+cw)/w-1
+    theta[:,1,0], theta[:,1,1], theta[:,1,2] = sy*sin,    sy*cos,   (2*y0+ch)/h-1
+    return theta
+
+# Cell
+def random_resized_crop_affine(x, size, n_views=1, scale=(0.08, 1.0), ratio=(3/4, 4/3), flip_p=0.5, rotate_deg=0., rotate_p=0.,
+                               same_on_batch=False, mode='bilinear', pad_mode='reflection'):
+    "`n_views` random resized crops of each image in `x`, flipped and rotated, with a single `grid_sample`"
+    bs, c, h, w = x.shape
+    n = n_views*bs
+    # parameters are drawn per view if `same_on_batch`, otherwise per sample
+    m = n_views if same_on_batch else n
+    x0, y0, cw, ch = sample_crop_boxes(m, h, w, scale, ratio, device=x.device)
+    flip = torch.rand(m, device=x.device) < flip_p
+    angle = None
+    if rotate_deg:
+        angle = torch.empty(m, device=x.device).uniform_(-rotate_deg, rotate_deg)
+        angle = angle * (torch.rand(m, device=x.device) < rotate_p)
+    theta = crop_flip_rotate_theta(x0, y0, cw, ch, h, w, flip, angle).to(x.dtype)
+    if m != n: theta = theta.repeat_interleave(bs, 0)
+    # views are stacked along the grid height, so that the input is not repeated `n_views` times
+    grid = F.affine_grid(theta, (n, c, size, size), align_corners=False)
+    grid = grid.view(n_views, bs, size, size, 2).transpose(0, 1).reshape(bs, n_views*size, size, 2)
+    out = F.grid_sample(x, grid, mode=mode, padding_mode=pad_mode, align_corners=False)
+    return out.view(bs, c, n_views, size, size).permute(2, 0, 1, 3, 4).reshape(n, c, size, size)
+
+# Cell
+class RandomResizedCropAffine(RandTransform):
+    "Per sample random resized crop, horizontal flip and rotation of a batch with a single resampling"
+    order = 0
+    def __init__(self, size, scale=(0.08, 1.0), ratio=(3/4, 4/3), flip_p=0.5, rotate_deg=0., rotate_p=0.,
+                 same_on_batch=False, mode='bilinear', pad_mode='reflection', **kwargs):
+        store_attr()
+        super().__init__(p=1., **kwargs)
+
+    def encodes(self, x:TensorImage):
+        return random_resized_crop_affine(x, self.size, 1, self.scale, self.ratio, self.flip_p, self.rotate_deg, self.rotate_p,
+                                          self.same_on_batch, mode=self.mode, pad_mode=self.pad_mode)
+
+# Cell
+_gray_weights = tensor([0.299, 0.587, 0.114])
+_rgb2yiq = tensor([[0.299, 0.587, 0.114], [0.596, -0.274, -0.322], [0.211, -0.523, 0.312]])
+
+
+def color_jitter_matrices(brightness, contrast, saturation, hue, gray):
+    "Per sample 3x3 color matrices for brightness, contrast (without mean offset), saturation, hue and grayscale"
+    dev = brightness.device
+    w, eye = _gray_weights.to(dev), torch.eye(3, device=dev)
+    s = saturation[:,None,None]
+    m = s*eye + (1-s)*w.expand(3,3)
+    # hue shift is approximated by a rotation around the luma axis in YIQ space, in the same direction as HSV hue
+    yiq, cos, sin = _rgb2yiq.to(dev), (2*math.pi*hue).cos(), (2*math.pi*hue).sin()
+    rot = torch.zeros(len(hue), 3, 3, device=dev)
+    rot[:,0,0], rot[:,1,1], rot[:,1,2], rot[:,2,1], rot[:,2,2] = 1, cos, sin, -sin, cos
+    m = torch.linalg.inv(yiq) @ rot @ yiq @ m * (brightness*contrast)[:,None,None]
+    return torch.where(gray[:,None,None], w.expand(3,3) @ m, m)
+
+
+def color_affine(x, brightness, contrast, saturation, hue, gray):
+    "Color jitter factors and grayscale flags of each image, or one for all images, applied as a 3x3 matrix and offset"
+    bs = x.size(0)
+    m = color_jitter_matrices(brightness, contrast, saturation, hue, gray).to(x.dtype).expand(bs, 3, 3)
+    # contrast blends with the mean gray level after brightness, which is kept by saturation, hue and grayscale
+    offset = ((1-contrast) * brightness).to(x) * (x.mean((2,3)) @ _gray_weights.to(x))
+    out = torch.baddbmm(offset[:,None,None], m, x.reshape(bs, 3, -1))
+    return out.view_as(x).clamp_(0, 1)
+
+
+class RandomColorAffine(RandTransform):
+    "Per sample color jitter and grayscale applied as a single 3x3 color matrix and offset per image"
+    order = 10
+    def __init__(self, brightness=0.4, contrast=0.4, saturation=0.4, hue=0.1, jitter_p=0.8, bw_p=0.2, same_on_batch=False,
+                 **kwargs):
+        store_attr()
+        super().__init__(p=1., **kwargs)
+
+    def _factors(self, f, do):
+        return torch.where(do, torch.empty(len(do), device=do.device).uniform_(max(0, 1-f), 1+f), torch.ones_like(do, dtype=torch.float))
+
+    def encodes(self, x:TensorImage):
+        n, dev = 1 if self.same_on_batch else x.size(0), x.device
+        do = torch.rand(n, device=dev) < self.jitter_p
+        b, c, s = self._factors(self.brightness, do), self._factors(self.contrast, do), self._factors(self.saturation, do)
+        h = torch.where(do, torch.empty(n, device=dev).uniform_(-self.hue, self.hue), torch.zeros(n, device=dev))
+        gray = torch.rand(n, device=dev) < self.bw_p
+        return color_affine(x, b, c, s, h, gray)
+
+# Cell
+def get_affine_batch_augs(size,
+                          rotate=True,
+                          jitter=True,
+                          bw=True,
+                          blur=True,
+                          resize_scale=(0.2, 1.0),
+                          resize_ratio=(3/4, 4/3),
+                          rotate_deg=30,
+                          jitter_s=.6,
+                          blur_s=(4,32),
+                          same_on_batch=False,
+                          flip_p=0.5, rotate_p=0.3, jitter_p=0.3, bw_p=0.3, blur_p=0.3,
+                          stats=imagenet_stats,
+                          cuda=default_device().type == 'cuda',
+                          xtra_tfms=[]):
+    "Input batch augmentations with per sample randomness, one resampling and one color matrix per image"
+    tfms = []
+    tfms += [RandomResizedCropAffine(size, scale=resize_scale, ratio=resize_ratio, flip_p=flip_p,
+                                     rotate_deg=rotate_deg if rotate else 0., rotate_p=rotate_p, same_on_batch=same_on_batch)]
+
+    if jitter or bw: tfms += [RandomColorAffine(*([0.8*jitter_s]*3+[0.2*jitter_s]), jitter_p=jitter_p if jitter else 0.,
+                                                bw_p=bw_p if bw else 0., same_on_batch=same_on_batch)]
+    if blur:         tfms += [RandomGaussianBlur(p=blur_p, s=blur_s, same_on_batch=same_on_batch)]
+
+    if stats is not None: tfms += [Normalize.from_stats(*stats, cuda=cuda)]
+
+    tfms += xtra_tfms
+    pipe = Pipeline(tfms, split_idx = 0)
+    return pipe
+
+# Cell
+batch_aug_backends = {'default':     get_batch_augs,
+                      'kornia':      get_kornia_batch_augs,
+                      'torchvision': get_torchvision_batch_augs,
+                      'fastai':      get_fastai_batch_augs,
+                      'affine':      get_affine_batch_augs}
+
+# Cell
+def _apply_tfm(t, x): return t(x, split_idx=0) if isinstance(t, Transform) else t(x)
+
+def _per_sample(t):
+    "Whether `t` draws random parameters per sample (or none at all), so that it can run once over all views"
+    if isinstance(t, (kornia.augmentation.AugmentationBase2D, RandomGaussianBlur, RandomColorAffine)): return not t.same_on_batch
+    return isinstance(t, Normalize)
+
+# Cell
+class MultiViewAugmentation:
+    "Create all views of a batch at once, with one resampling and one pass of each color transform per crop size"
+    def __init__(self, num_crops=(2,), crop_sizes=(224,), min_scales=None, max_scales=None, backend='default', **kwargs):
+        """
+            num_crops, crop_sizes:  Number of views and their size for each resolution, e.g. (2,6) and (224,96).
+            min_scales, max_scales: RandomResizedCrop scales for each resolution, defaults to `resize_scale`.
+            backend:                'default' for kornia color transforms or 'affine' for `RandomColorAffine`.
+            kwargs:                 Any argument of `get_batch_augs`, shared by all views.
+        """
+        assert backend in ('default', 'affine'), "MultiViewAugmentation supports the 'default' and 'affine' backends"
+        kw = {k:p.default for k,p in inspect.signature(get_batch_augs).parameters.items() if k != 'size'}
+        kw.update(kwargs)
+        min_scales = ifnone(min_scales, [kw['resize_scale'][0]]*len(num_crops))
+        max_scales = ifnone(max_scales, [kw['resize_scale'][1]]*len(num_crops))
+        self.kw, self.groups, self.pipelines = kw, [], []
+        for nc, size, mins, maxs in zip(num_crops, crop_sizes, min_scales, max_scales):
+            self.groups.append((nc, size, (mins, maxs)))
+            # equivalent per view pipelines, used for decoding, showing and printing the views
+            self.pipelines += get_multi_aug_pipelines(nc, size, backend=backend, **merge(kwargs, dict(resize_scale=(mins, maxs))))
+
+        tfms = []
+        if backend == 'affine':
+            if kw['jitter'] or kw['bw']:
+                tfms += [RandomColorAffine(*([0.8*kw['jitter_s']]*3+[0.2*kw['jitter_s']]), jitter_p=kw['jitter_p'] if kw['jitter'] else 0.,
+                                           bw_p=kw['bw_p'] if kw['bw'] else 0., same_on_batch=kw['same_on_batch'])]
+        else:
+            if kw['jitter']: tfms += [korniatfm.ColorJitter(0.8*kw['jitter_s'], 0.8*kw['jitter_s'], 0.8*kw['jitter_s'], 0.2*kw['jitter_s'],
+                                                            p=kw['jitter_p'], same_on_batch=kw['same_on_batch'])]
+            if kw['bw']:     tfms += [korniatfm.RandomGrayscale(p=kw['bw_p'], same_on_batch=kw['same_on_batch'])]
+        if kw['blur']:   tfms += [RandomGaussianBlur(p=kw['blur_p'], s=kw['blur_s'], same_on_batch=kw['same_on_batch'])]
+        if kw['stats'] is not None: tfms += [Normalize.from_stats(*kw['stats'], cuda=kw['cuda'])]
+        tfms += kw['xtra_tfms']
+        self.color_tfms = sorted(tfms, key=lambda t: getattr(t, 'order', 0))
+
+    def __len__(self): return len(self.pipelines)
+    def __getitem__(self, i): return self.pipelines[i]
+    def __iter__(self): return iter(self.pipelines)
+    def __repr__(self):
+        return f"{self.__class__.__name__}: (num_crops, size)={[(nc, size) for nc,size,_ in self.groups]}, {[type(t).__name__ for t in self.color_tfms]}"
+
+    def _apply_tfm(self, t, x): return _apply_tfm(t, x)
+
+    def _geometric(self, x, nc, size, scale):
+        kw = self.kw
+        return random_resized_crop_affine(x, size, nc, scale, kw['resize_ratio'], kw['flip_p'],
+                                          kw['rotate_deg'] if kw['rotate'] else 0., kw['rotate_p'], kw['same_on_batch'])
+
+    def __call__(self, x):
+        "List of augmented views of batch `x` in the order of `self.pipelines`"
+        views, bs = [], x.size(0)
+        for nc, size, scale in self.groups:
+            xv = TensorImage(self._geometric(x, nc, size, scale))
+            for t in self.color_tfms:
+                if _per_sample(t): xv = self._apply_tfm(t, xv)
+                else:              xv = torch.cat([self._apply_tfm(t, o) for o in xv.split(bs)])
+            views += list(TensorImage(xv).split(bs))
+        return views
+
 # Cell
 @delegates(get_batch_augs)
-def get_multi_aug_pipelines(n, size, **kwargs): return [get_batch_augs(size, **kwargs) for i in range(n)]
+def get_multi_aug_pipelines(n, size, vectorized=False, backend='default', **kwargs):
+    "`n` augmentation pipelines of one of `batch_aug_backends`, or a `MultiViewAugmentation` creating all views at once if `vectorized`"
+    if vectorized: return MultiViewAugmentation(num_crops=(n,), crop_sizes=(size,), backend=backend, **kwargs)
+    return [batch_aug_backends[backend](size, **kwargs) for i in range(n)]
 
 # Cell
 from typing import List
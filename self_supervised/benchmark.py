@@ -0,0 +1,168 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/05 - benchmark.ipynb (unless otherwise specified).
+
+__all__ = ['peak_memory', 'benchmark', 'AugProfiler', 'ProfileAugs']
+
+# Cell
+import os
+import time
+import ctypes
+import threading
+import torch
+
+# Cell
+def _rss():
+    "Resident set size of this process in bytes, None if not available"
+    try:
+        with open('/proc/self/statm') as f: return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError): return None
+
+
+def _trim():
+    "Return freed heap memory to the OS so that the next allocations show up in the resident set size"
+    try:    ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError): pass
+
+
+def _sync(device):
+    if device is not None and torch.device(device).type == 'cuda': torch.cuda.synchronize(device)
+
+
+def peak_memory(f, device=None, interval=5e-4):
+    "Peak memory in MB allocated while calling `f`, None if it can't be measured"
+    if device is not None and torch.device(device).type == 'cuda':
+        _sync(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+        f(); _sync(device)
+        return (torch.cuda.max_memory_allocated(device) - base) / 2**20
+    _trim()
+    base = _rss()
+    if base is None: f(); return None
+    peak, done = [base], threading.Event()
+    def _sample():
+        while not done.is_set():
+            peak[0] = max(peak[0], _rss())
+            time.sleep(interval)
+    t = threading.Thread(target=_sample, daemon=True)
+    t.start()
+    try:     f()
+    finally: done.set(); t.join()
+    return (max(peak[0], _rss()) - base) / 2**20
+
+
+def benchmark(f, n_iter=10, n_warmup=2, device=None):
+    "Mean wall time in ms and peak memory in MB of calling `f`"
+    for _ in range(n_warmup): f()
+    _sync(device)
+    start = time.perf_counter()
+    for _ in range(n_iter): f()
+    _sync(device)
+    return dict(time_ms=(time.perf_counter()-start)/n_iter*1000, peak_mb=peak_memory(f, device))
+
+# Cell
+from collections import defaultdict
+from functools import partial
+from fastcore.foundation import L
+from fastai.callback.core import Callback
+import pandas as pd
+
+# Cell
+class _ProfiledTfm:
+    "Transform wrapper which records each call in an `AugProfiler`"
+    def __init__(self, tfm, profiler, key): self.tfm, self.profiler, self.key = tfm, profiler, key
+    def __call__(self, x, **kwargs): return self.profiler._record(self.key, self.tfm, x, **kwargs)
+    def decode(self, x, **kwargs): return self.tfm.decode(x, **kwargs)
+    def __getattr__(self, k):
+        if k == 'tfm': raise AttributeError(k)
+        return getattr(self.tfm, k)
+    def __repr__(self): return repr(self.tfm)
+
+
+def _tfm_name(t):
+    "Class name of a transform, or name of the function or module a generic `Transform` wraps"
+    name = type(t).__name__
+    return getattr(t, 'name', name) if name == 'Transform' else name
+
+
+class AugProfiler:
+    "Per transform and per view wall time, device sync time and allocated memory of augmentation pipelines"
+    def __init__(self, device=None): self.device, self.pipelines, self.records = device, [], defaultdict(list)
+
+    def wrap(self, aug_pipelines, backend='default'):
+        "Instrument each transform of `aug_pipelines` in place, view `i` is the i-th pipeline"
+        from .augmentations import MultiViewAugmentation
+        if isinstance(aug_pipelines, MultiViewAugmentation): return self._wrap_multi_view(aug_pipelines, backend)
+        assert all(hasattr(pipe, 'fs') for pipe in aug_pipelines), \
+            "aug_pipelines needs to be a list of `Pipeline`s or a `MultiViewAugmentation`"
+        for view, pipe in enumerate(aug_pipelines):
+            self.pipelines.append((pipe, pipe.fs))
+            pipe.fs = L(_ProfiledTfm(t, self, (backend, view, i, _tfm_name(t))) for i,t in enumerate(pipe.fs))
+        return aug_pipelines
+
+    def _wrap_multi_view(self, mv, backend):
+        "Instrument the resampling and color transforms of a `MultiViewAugmentation`, which process all views at once"
+        orders = {id(t): i+1 for i,t in enumerate(mv.color_tfms)}
+        geometric, apply_tfm = mv._geometric, mv._apply_tfm
+        mv._geometric = lambda x, *args: self._record((backend, 'all', 0, 'random_resized_crop_affine'),
+                                                      lambda x: geometric(x, *args), x)
+        mv._apply_tfm = lambda t, x: self._record((backend, 'all', orders[id(t)], _tfm_name(t)), partial(apply_tfm, t), x)
+        self.pipelines.append((mv, None))
+        return mv
+
+    def unwrap(self):
+        "Restore the original transforms"
+        for pipe, fs in self.pipelines:
+            if fs is None: del pipe._geometric, pipe._apply_tfm
+            else:          pipe.fs = fs
+        self.pipelines = []
+
+    def reset(self): self.records = defaultdict(list)
+
+    def _record(self, key, tfm, x, **kwargs):
+        cuda = self.device is not None and torch.device(self.device).type == 'cuda'
+        _sync(self.device)
+        if cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+            base = torch.cuda.memory_allocated(self.device)
+        start = time.perf_counter()
+        out = tfm(x, **kwargs)
+        launched = time.perf_counter()
+        _sync(self.device)
+        end = time.perf_counter()
+        if cuda:                          mem = torch.cuda.max_memory_allocated(self.device) - base
+        elif isinstance(out, torch.Tensor): mem = out.nelement()*out.element_size()
+        else:                             mem = 0
+        self.records[key].append((end-start, end-launched, mem))
+        return out
+
+    def table(self, per_view=True):
+        "Mean time in ms, sync time in ms and allocated memory in MB per call of each transform, slowest first"
+        rows = [dict(backend=b, view=v, order=i, transform=n, calls=len(r),
+                     time_ms=1000*sum(o[0] for o in r)/len(r), sync_ms=1000*sum(o[1] for o in r)/len(r),
+                     alloc_mb=sum(o[2] for o in r)/len(r)/2**20)
+                for (b,v,i,n),r in self.records.items()]
+        cols = ['backend','view','transform','calls','time_ms','sync_ms','alloc_mb']
+        if not rows: return pd.DataFrame(columns=cols)
+        df = pd.DataFrame(rows)
+        if not per_view:
+            df = df.groupby(['backend','order','transform'], as_index=False).agg(
+                view=('view', 'count'), calls=('calls','sum'), time_ms=('time_ms','mean'), sync_ms=('sync_ms','mean'),
+                alloc_mb=('alloc_mb','mean')).rename(columns={'view': 'views'})
+            cols = ['backend','views','transform','calls','time_ms','sync_ms','alloc_mb']
+        df['total_ms'] = df.time_ms*df.calls
+        return df[cols+['total_ms']].sort_values('total_ms', ascending=False).reset_index(drop=True)
+
+# Cell
+class ProfileAugs(Callback):
+    "Record per transform timings of `aug_pipelines` over each epoch"
+    def __init__(self, aug_pipelines, backend='default', per_view=True):
+        self.aug_pipelines, self.backend, self.per_view = aug_pipelines, backend, per_view
+        self.profiler, self.tables = None, []
+
+    def before_fit(self):
+        self.profiler = AugProfiler(self.dls.device)
+        self.profiler.wrap(self.aug_pipelines, self.backend)
+
+    def before_epoch(self): self.profiler.reset()
+    def after_epoch(self):  self.tables.append(self.profiler.table(self.per_view))
+    def after_fit(self):    self.profiler.unwrap()
\ No newline at end of file
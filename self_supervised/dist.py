@@ -1,11 +1,66 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/03 - distributed.ipynb (unless otherwise specified).
 
-__all__ = ['GatherLayer']
+__all__ = ['get_world_size', 'get_rank', 'AsyncGather', 'all_gather_with_grad', 'GatherLayer', 'concat_all_gather',
+           'batch_shuffle', 'batch_unshuffle', 'all_reduce', 'run_gloo']
 
 # Cell
 import torch
 import torch.distributed as dist
 
+# Cell
+def get_world_size():
+    "Number of processes, 1 outside of distributed training"
+    return dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
+def get_rank():
+    "Rank of this process, 0 outside of distributed training"
+    return dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+
+def _dist_fn(*names):
+    "First of `names` in `torch.distributed`, single tensor collectives were renamed across torch versions"
+    return next(getattr(dist, n) for n in names if hasattr(dist, n))
+
+def _all_gather_into(out, x, async_op=False):
+    return _dist_fn('all_gather_into_tensor', '_all_gather_base')(out, x.contiguous(), async_op=async_op)
+
+def _reduce_scatter(x):
+    "Sum of the local slices of `x` over all processes"
+    out = x.new_empty((x.size(0)//get_world_size(), *x.shape[1:]))
+    _dist_fn('reduce_scatter_tensor', '_reduce_scatter_base')(out, x.contiguous())
+    return out
+
+def _gather_buffer(x): return x.new_empty((get_world_size()*x.size(0), *x.shape[1:]))
+
+# Cell
+class _AllGather(torch.autograd.Function):
+    "`gathered` features of all processes as an output of `input`, backward reduce-scatters gradients"
+    @staticmethod
+    def forward(ctx, input, gathered): return gathered
+
+    @staticmethod
+    def backward(ctx, grad): return _reduce_scatter(grad), None
+
+
+class AsyncGather:
+    "Handle of an all gather which is in flight, `wait` returns the gathered tensor"
+    def __init__(self, x):
+        self.x, self.work = x, None
+        if get_world_size() == 1: return
+        self.gathered = _gather_buffer(x)
+        self.work = _all_gather_into(self.gathered, x.detach(), async_op=True)
+
+    def wait(self):
+        if self.work is None: return self.x
+        self.work.wait()
+        return _AllGather.apply(self.x, self.gathered)
+
+
+def all_gather_with_grad(x, async_op=False):
+    "Concatenate `x` from all processes along the first dimension, gradients of the local slice are summed over processes"
+    handle = AsyncGather(x)
+    return handle if async_op else handle.wait()
+
 # Cell
 class GatherLayer(torch.autograd.Function):
     '''Gather tensors from all process, supporting backward propagation.
@@ -14,15 +69,62 @@ class GatherLayer(torch.autograd.Function):
 
     @staticmethod
     def forward(ctx, input):
-        ctx.save_for_backward(input)
-        output = [torch.zeros_like(input) \
-            for _ in range(dist.get_world_size())]
-        dist.all_gather(output, input)
-        return tuple(output)
+        output = _gather_buffer(input)
+        _all_gather_into(output, input)
+        return tuple(output.chunk(get_world_size()))
 
     @staticmethod
-    def backward(ctx, *grads):
-        input, = ctx.saved_tensors
-        grad_out = torch.zeros_like(input)
-        grad_out[:] = grads[dist.get_rank()]
-        return grad_out
\ No newline at end of file
+    def backward(ctx, *grads): return _reduce_scatter(torch.cat(grads))
+
+# Cell
+@torch.no_grad()
+def concat_all_gather(x):
+    "Concatenate `x` from all processes along the first dimension, without gradient"
+    if get_world_size() == 1: return x
+    out = _gather_buffer(x)
+    _all_gather_into(out, x)
+    return out
+
+# Cell
+@torch.no_grad()
+def batch_shuffle(x):
+    "Local part of the global batch shuffled across processes and the indexes to unshuffle it"
+    if get_world_size() == 1: return x, torch.arange(len(x), device=x.device)
+    x_all = concat_all_gather(x)
+    idx_shuffle = torch.randperm(len(x_all), device=x.device)
+    dist.broadcast(idx_shuffle, src=0)
+    return x_all[idx_shuffle.view(get_world_size(), -1)[get_rank()]], torch.argsort(idx_shuffle)
+
+
+@torch.no_grad()
+def batch_unshuffle(x, idx_unshuffle):
+    "Outputs of a shuffled batch in the order of the local batch"
+    if get_world_size() == 1: return x[idx_unshuffle]
+    return concat_all_gather(x)[idx_unshuffle.view(get_world_size(), -1)[get_rank()]]
+
+# Cell
+_reduce_ops = {'sum': 'SUM', 'mean': 'SUM', 'max': 'MAX', 'min': 'MIN'}
+
+@torch.no_grad()
+def all_reduce(x, op='sum'):
+    "Reduce `x` in place over all processes with `op`, one of 'sum', 'mean', 'max' or 'min'"
+    assert op in _reduce_ops, f"op needs to be one of {list(_reduce_ops)}"
+    if get_world_size() == 1: return x
+    dist.all_reduce(x, op=getattr(dist.ReduceOp, _reduce_ops[op]))
+    return x.div_(get_world_size()) if op == 'mean' else x
+
+# Cell
+import tempfile
+import torch.multiprocessing as mp
+
+# Cell
+def run_gloo(f, world_size, *args):
+    "Run `f(rank, *args)` in `world_size` forked processes with the gloo backend and return results of all ranks"
+    def _run(rank, results, init_method):
+        dist.init_process_group('gloo', init_method=init_method, rank=rank, world_size=world_size)
+        try:     results[rank] = f(rank, *args)
+        finally: dist.destroy_process_group()
+    results = mp.Manager().dict()
+    with tempfile.TemporaryDirectory() as d:
+        mp.start_processes(_run, args=(results, f'file://{d}/init'), nprocs=world_size, start_method='fork')
+    return [results[i] for i in range(world_size)]
\ No newline at end of file
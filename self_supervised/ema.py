@@ -0,0 +1,116 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/04 - ema.ipynb (unless otherwise specified).
+
+__all__ = ['flatten_tensors_', 'EMA']
+
+# Cell
+import torch
+from torch import nn
+
+# Cell
+def _tensors(o):
+    "Parameters of a module or a list of tensors"
+    return list(o.parameters()) if isinstance(o, nn.Module) else list(o)
+
+
+def _buffers(o):
+    "Buffers of a module or a list of tensors"
+    return list(o.buffers()) if isinstance(o, nn.Module) else list(o)
+
+
+def flatten_tensors_(tensors):
+    "Copy `tensors` into a single contiguous buffer and replace each tensor's `.data` with a view of it"
+    flat = torch.cat([t.data.reshape(-1) for t in tensors])
+    offset = 0
+    for t in tensors:
+        n = t.numel()
+        t.data = flat[offset:offset+n].view_as(t.data)
+        offset += n
+    return flat
+
+
+def _storage_numel(t):
+    return t.untyped_storage().nbytes() // t.element_size() if hasattr(t, 'untyped_storage') else t.storage().size()
+
+
+def _clone_flat_views(module, state_dict, prefix, local_metadata):
+    "`state_dict` hook saving parameters which are views of a flat buffer on their own instead of the whole buffer"
+    for name, p in module._parameters.items():
+        k = prefix + name
+        if p is None or k not in state_dict or isinstance(state_dict[k], nn.Parameter): continue
+        if _storage_numel(state_dict[k]) > state_dict[k].numel(): state_dict[k] = state_dict[k].clone()
+
+
+def _register_clone_flat_views(module):
+    "Register `_clone_flat_views` once on each submodule with parameters, also if `EMA` is created again every fit"
+    for m in module.modules():
+        if m._parameters and _clone_flat_views not in m._state_dict_hooks.values():
+            m._register_state_dict_hook(_clone_flat_views)
+
+
+def _is_view_of(flat, tensors):
+    "Check first and last tensor still point into `flat`, e.g. they are invalidated by `model.to(device)`"
+    first, last = tensors[0], tensors[-1]
+    return (first.data_ptr() == flat.data_ptr() and
+            last.data_ptr() == flat.data_ptr() + (flat.numel() - last.numel())*flat.element_size())
+
+# Cell
+class EMA:
+    "Multi-tensor `target = m*target + (1-m)*online` update of parameters and optionally buffers"
+    def __init__(self, online, target, flatten=True, buffers=None):
+        """
+            online, target: `nn.Module`s or lists of matching tensors.
+            flatten:        Store each dtype/device group in a contiguous buffer and update it with a single op.
+            buffers:        None to leave target buffers untouched, 'ema' to average float buffers (e.g. BN running
+                            stats) and copy the rest, 'copy' to copy all buffers from online to target.
+        """
+        assert buffers in (None, 'ema', 'copy'), "buffers needs to be one of None, 'ema' or 'copy'"
+        self.online, self.target = _tensors(online), _tensors(target)
+        assert len(self.online) == len(self.target), "online and target need to have the same number of tensors"
+        self.flatten, self.buffers = flatten, buffers
+        self.online_bufs = _buffers(online) if (buffers is not None and isinstance(online, nn.Module)) else []
+        self.target_bufs = _buffers(target) if (buffers is not None and isinstance(target, nn.Module)) else []
+        self.groups = None
+        # without copies `torch.save(model.encoder.state_dict())` would write the whole flat buffer
+        if flatten:
+            for m in [o for o in (online, target) if isinstance(o, nn.Module)]: _register_clone_flat_views(m)
+
+
+    def _setup(self):
+        "Group matching tensor pairs by dtype and device, flatten groups and keep the rest for foreach updates"
+        groups = {}
+        self.rest_online, self.rest_target = [], []
+        for o,t in zip(self.online, self.target):
+            if self.flatten and o.dtype == t.dtype and o.device == t.device and o.shape == t.shape:
+                groups.setdefault((o.dtype, o.device), ([],[]))
+                groups[(o.dtype, o.device)][0].append(o)
+                groups[(o.dtype, o.device)][1].append(t)
+            else:
+                self.rest_online.append(o); self.rest_target.append(t)
+        self.groups = []
+        for ons,ts in groups.values(): self.groups.append((ons, flatten_tensors_(ons), ts, flatten_tensors_(ts)))
+
+
+    def _valid(self):
+        return all(_is_view_of(of, ons) and _is_view_of(tf, ts) for ons,of,ts,tf in self.groups)
+
+
+    @torch.no_grad()
+    def update(self, m):
+        "Move target towards online with momentum `m`"
+        if self.groups is None or not self._valid(): self._setup()
+        for _,of,_,tf in self.groups: tf.lerp_(of, 1.-m)
+        if self.rest_target:
+            torch._foreach_mul_(self.rest_target, m)
+            torch._foreach_add_(self.rest_target, [o.to(t.dtype) for o,t in zip(self.rest_online, self.rest_target)],
+                                alpha=1.-m)
+        if self.buffers is not None: self._update_buffers(m)
+
+
+    def _update_buffers(self, m):
+        ema = [(o,t) for o,t in zip(self.online_bufs, self.target_bufs)
+               if self.buffers == 'ema' and t.is_floating_point()]
+        if ema:
+            torch._foreach_mul_([t for _,t in ema], m)
+            torch._foreach_add_([t for _,t in ema], [o for o,_ in ema], alpha=1.-m)
+        for o,t in zip(self.online_bufs, self.target_bufs):
+            if not (self.buffers == 'ema' and t.is_floating_point()): t.copy_(o)
\ No newline at end of file
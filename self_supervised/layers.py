@@ -2,7 +2,8 @@
 
 __all__ = ['PoolingType', '_splitter', 'create_fastai_encoder', 'create_timm_encoder', 'create_encoder',
            'create_mlp_module', 'create_cls_module', 'create_model', 'CheckpointResNet', 'CheckpointEfficientNet',
-           'CheckpointVisionTransformer', 'CheckpointSequential']
+           'CheckpointVisionTransformer', 'CheckpointSequential', 'split_batchnorm', 'FeatureQueue',
+           'ddp_ignore_queues', 'GradCache']
 
 # Cell
 from fastai.vision.all import *
@@ -162,4 +163,130 @@ class CheckpointSequential(Module):
 
     def forward(self, x):
         x = checkpoint_sequential(self.fastai_model, self.checkpoint_nchunks, x)
-        return x
\ No newline at end of file
+        return x
+
+# Cell
+def _chunked_forward(forward, n_chunks, x): return torch.cat([forward(o) for o in x.chunk(n_chunks)])
+
+@contextmanager
+def split_batchnorm(model, n_chunks=2):
+    "Normalize each of `n_chunks` parts of the batch with its own statistics in all BatchNorm layers of `model`"
+    bns = [m for m in model.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    for bn in bns: bn.forward = partial(_chunked_forward, type(bn).forward.__get__(bn), n_chunks)
+    try:     yield model
+    finally:
+        for bn in bns: del bn.forward
+
+# Cell
+from .dist import concat_all_gather
+
+# Cell
+class FeatureQueue(Module):
+    "Circular queue of the last `K` features of size `dim` stored in a buffer"
+    def __init__(self, K, dim, normalize=True, gather=False):
+        self.K, self.gather = K, gather
+        features = torch.randn(K, dim)
+        self.register_buffer('features', F.normalize(features, dim=1) if normalize else features)
+        self.register_buffer('ptr', torch.zeros((), dtype=torch.long))
+
+    @torch.no_grad()
+    def enqueue(self, x):
+        "Write `x` after the last written feature, wrapping around the end of the queue"
+        if self.gather: x = concat_all_gather(x)
+        x = x.detach()[-self.K:]
+        idxs = torch.arange(len(x), device=self.ptr.device).add_(self.ptr).remainder_(self.K)
+        self.features.index_copy_(0, idxs, x.to(self.features.dtype))
+        self.ptr.add_(len(x)).remainder_(self.K)
+
+    def forward(self): return self.features
+    def __len__(self): return self.K
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs)
+        # checkpoints from before the queue was part of the model, the queue keeps its initial state
+        keys = [prefix+'features', prefix+'ptr']
+        if not any(k in state_dict for k in keys): missing_keys[:] = [k for k in missing_keys if k not in keys]
+
+# Cell
+from torch.nn.parallel import DistributedDataParallel
+
+def ddp_ignore_queues(model):
+    "Exclude the buffers of all `FeatureQueue`s in `model` from syncing by `DistributedDataParallel`"
+    names = [f'{n}.{b}' for n, m in model.named_modules() if isinstance(m, FeatureQueue) for b, _ in m.named_buffers()]
+    ignored = getattr(model, '_ddp_params_and_buffers_to_ignore', [])
+    DistributedDataParallel._set_params_and_buffers_to_ignore_for_model(model, list(dict.fromkeys([*ignored, *names])))
+    return model
+
+# Cell
+from contextlib import nullcontext
+from torch.nn.modules.batchnorm import _BatchNorm
+
+# Cell
+def _as_tuple(o): return (o,) if isinstance(o, Tensor) else tuple(o)
+
+def _rng_state():
+    return torch.get_rng_state(), (torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None)
+
+def _set_rng_state(state):
+    torch.set_rng_state(state[0])
+    if state[1] is not None: torch.cuda.set_rng_state_all(state[1])
+
+def _loss_params(loss, params):
+    "Parameters in `params` which are leaves of the autograd graph of `loss`"
+    ids, seen, fns, res = {id(p) for p in params}, set(), [loss.grad_fn], []
+    while fns:
+        fn = fns.pop()
+        if fn is None or fn in seen: continue
+        seen.add(fn)
+        v = getattr(fn, 'variable', None)
+        if v is not None and id(v) in ids: res.append(v)
+        fns += [f for f,_ in fn.next_functions]
+    return res
+
+
+class GradCache(Callback):
+    "Compute the loss over the full batch with the activation memory of micro-batches of `chunk_size` samples"
+    order = 50 # after callbacks which build `xb` in `before_batch`
+    def __init__(self, chunk_size): self.chunk_size, self.reps = chunk_size, None
+
+    def before_batch(self):
+        "Cache embeddings of all micro-batches and let the model return them in the forward of the full batch"
+        if not self.training: return
+        self.chunks = list(zip(*[x.split(self.chunk_size) for x in self.learn.xb]))
+        bn_state = [(m, deepcopy(m._buffers)) for m in self.model.modules() if isinstance(m, _BatchNorm)]
+        self.rng_states, outs = [], []
+        with torch.no_grad():
+            for xb in self.chunks:
+                self.rng_states.append(_rng_state())
+                out = self.model(*xb)
+                outs.append(_as_tuple(out))
+        for m, bufs in bn_state: m._buffers.update(bufs)
+        reps = tuple(torch.cat(o).requires_grad_() for o in zip(*outs))
+        self.reps = reps[0] if isinstance(out, Tensor) else reps
+        self.model.forward = lambda *args, **kwargs: self.reps
+
+    def after_pred(self):
+        if 'forward' in self.model.__dict__: del self.model.forward
+
+    def after_backward(self):
+        "Backpropagate the cached embedding gradients through each micro-batch"
+        if self.reps is None: return
+        grads = [r.grad for r in _as_tuple(self.reps)]
+        # the full batch forward bypassed DDP, parameters only used by the loss need to join a synchronized backward
+        loss_params = _loss_params(self.learn.loss_grad, self.model.parameters()) if hasattr(self.model, 'no_sync') else []
+        autocast = getattr(self.learn, 'mixed_precision', None)
+        rng = _rng_state()
+        for i, xb in enumerate(self.chunks):
+            sl = slice(i*self.chunk_size, (i+1)*self.chunk_size)
+            last = i == len(self.chunks)-1
+            _set_rng_state(self.rng_states[i])
+            with (self.model.no_sync() if hasattr(self.model, 'no_sync') and not last else nullcontext()), \
+                 (autocast.autocast if autocast is not None else nullcontext()):
+                outs = _as_tuple(self.model(*xb))
+            outs, gs = zip(*[(o, g[sl].to(o.dtype)) for o,g in zip(outs, grads) if g is not None])
+            if last: outs, gs = outs + tuple(loss_params), gs + tuple(torch.zeros_like(p) for p in loss_params)
+            torch.autograd.backward(outs, gs)
+        _set_rng_state(rng)
+        self.reps, self.chunks, self.rng_states = None, None, None
+
+    def after_cancel_batch(self): self.after_pred()
\ No newline at end of file
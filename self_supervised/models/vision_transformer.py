@@ -9,6 +9,7 @@ from torch import nn
 import math
 from functools import partial
 from fastcore.meta import delegates
+from torch.utils.checkpoint import checkpoint
 
 # Cell
 def _no_grad_trunc_normal_(tensor, mean, std, a, b):
@@ -53,13 +54,16 @@ def trunc_normal_(tensor, mean=0., std=1., a=-2., b=2.):
     return _no_grad_trunc_normal_(tensor, mean, std, a, b)
 
 # Cell
-def drop_path(x, drop_prob: float = 0., training: bool = False):
+def drop_path(x, drop_prob: float = 0., training: bool = False, ids=None):
     if drop_prob == 0. or not training:
         return x
     keep_prob = 1 - drop_prob
     shape = (x.shape[0],) + (1,) * (x.ndim - 1)  # work with diff dim tensors, not just 2D ConvNets
+    if ids is not None: shape = (ids.numel(),)
     random_tensor = keep_prob + torch.rand(shape, dtype=x.dtype, device=x.device)
     random_tensor.floor_()  # binarize
+    # one decision per id, e.g. per crop of packed sequences, instead of per sample
+    if ids is not None: random_tensor = random_tensor[ids].view(*ids.shape, *(1,) * (x.ndim - ids.ndim))
     output = x.div(keep_prob) * random_tensor
     return output
 
@@ -71,8 +75,8 @@ class DropPath(nn.Module):
         super(DropPath, self).__init__()
         self.drop_prob = drop_prob
 
-    def forward(self, x):
-        return drop_path(x, self.drop_prob, self.training)
+    def forward(self, x, ids=None):
+        return drop_path(x, self.drop_prob, self.training, ids)
 
 
 class Mlp(nn.Module):
@@ -94,53 +98,112 @@ class Mlp(nn.Module):
         return x
 
 
+_has_sdpa = hasattr(nn.functional, 'scaled_dot_product_attention')
+
+
 class Attention(nn.Module):
-    def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0.):
+    def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0.,
+                 attn_mode='fused', chunk_size=128):
+        """
+            attn_mode:  'fused' uses `scaled_dot_product_attention` and falls back to 'chunked' if it is not available,
+                        'chunked' computes attention for `chunk_size` queries at a time and 'explicit' materializes
+                        the full attention matrix. Attention weights are always computed explicitly if requested.
+            chunk_size: Number of queries per chunk of 'chunked' attention.
+        """
         super().__init__()
+        assert attn_mode in ('fused', 'chunked', 'explicit'), f"Unknown attention mode: {attn_mode}"
         self.num_heads = num_heads
         head_dim = dim // num_heads
         self.scale = qk_scale or head_dim ** -0.5
+        self.attn_mode, self.chunk_size = attn_mode, chunk_size
 
         self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
         self.attn_drop = nn.Dropout(attn_drop)
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
 
-    def forward(self, x):
+    def _attn_weights(self, q, k, attn_mask=None):
+        attn = (q @ k.transpose(-2, -1)) * self.scale
+        if attn_mask is not None: attn = attn.masked_fill(~attn_mask, float('-inf'))
+        return attn.softmax(dim=-1)
+
+    def _chunk(self, q, k, v, attn_mask=None): return self.attn_drop(self._attn_weights(q, k, attn_mask)) @ v
+
+    def _chunked(self, q, k, v, attn_mask=None):
+        "Attention for chunks of queries, with checkpointing in training so that no chunk's weights are kept for backward"
+        chunk = partial(checkpoint, self._chunk, use_reentrant=False) if torch.is_grad_enabled() else self._chunk
+        qcs = q.split(self.chunk_size, dim=2)
+        masks = [None]*len(qcs) if attn_mask is None else attn_mask.split(self.chunk_size, dim=2)
+        return torch.cat([chunk(qc, k, v, m) for qc, m in zip(qcs, masks)], dim=2)
+
+    def _fused(self, q, k, v, attn_mask=None):
+        # `scaled_dot_product_attention` scales by head_dim ** -0.5, a custom `qk_scale` is applied to the queries
+        if self.scale != q.size(-1) ** -0.5: q = q * (self.scale * q.size(-1) ** 0.5)
+        dropout_p = self.attn_drop.p if self.training else 0.
+        return nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p)
+
+    def forward(self, x, return_attention=False, attn_mask=None):
+        "`attn_mask` is a boolean mask broadcastable to (B, heads, N, N) of the keys each query attends to"
         B, N, C = x.shape
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
+        if return_attention:
+            attn = self._attn_weights(q, k, attn_mask)
+            x = self.attn_drop(attn) @ v
+        elif self.attn_mode == 'explicit':            x = self._chunk(q, k, v, attn_mask)
+        elif self.attn_mode == 'fused' and _has_sdpa: x = self._fused(q, k, v, attn_mask)
+        else:                                         x = self._chunked(q, k, v, attn_mask)
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
-        return x, attn
+        return (x, attn) if return_attention else x
 
 
 class Block(nn.Module):
     def __init__(self, dim, num_heads, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop=0., attn_drop=0.,
-                 drop_path=0., act_layer=nn.GELU, norm_layer=nn.LayerNorm):
+                 drop_path=0., act_layer=nn.GELU, norm_layer=nn.LayerNorm, attn_mode='fused', chunk_size=128,
+                 skip_dropped=False):
+        """
+            skip_dropped: In training only run the attention and mlp branches on the samples which stochastic depth
+                          keeps, instead of computing them for all samples and multiplying the dropped ones by zero.
+                          Packed sequences, which drop their crops independently, compute the branches for all crops.
+        """
         super().__init__()
+        self.skip_dropped = skip_dropped
         self.norm1 = norm_layer(dim)
         self.attn = Attention(
-            dim, num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop)
+            dim, num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop,
+            attn_mode=attn_mode, chunk_size=chunk_size)
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
         self.norm2 = norm_layer(dim)
         mlp_hidden_dim = int(dim * mlp_ratio)
         self.mlp = Mlp(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop)
 
-    def forward(self, x, return_attention=False):
-        y, attn = self.attn(self.norm1(x))
+    def forward(self, x, return_attention=False, attn_mask=None, crop_ids=None):
+        "`crop_ids` of the tokens of packed sequences make stochastic depth drop each crop on its own"
         if return_attention:
-            return attn
-        x = x + self.drop_path(y)
-        x = x + self.drop_path(self.mlp(self.norm2(x)))
+            return self.attn(self.norm1(x), return_attention=True, attn_mask=attn_mask)[1]
+        if self.skip_dropped and self.training and isinstance(self.drop_path, DropPath) and crop_ids is None:
+            x = self._kept_residual(x, lambda x, m: self.attn(self.norm1(x), attn_mask=m), attn_mask)
+            return self._kept_residual(x, lambda x, m: self.mlp(self.norm2(x)))
+        x = x + self._drop_path(self.attn(self.norm1(x), attn_mask=attn_mask), crop_ids)
+        x = x + self._drop_path(self.mlp(self.norm2(x)), crop_ids)
         return x
 
+    def _drop_path(self, x, crop_ids=None):
+        return self.drop_path(x, crop_ids) if isinstance(self.drop_path, DropPath) else x
+
+    def _kept_residual(self, x, branch, attn_mask=None):
+        "`x + drop_path(branch(x))` with the branch computed only for the samples which are kept"
+        drop_prob = self.drop_path.drop_prob
+        # each sample is kept with probability 1 - drop_prob as in `drop_path`
+        idxs = (torch.rand(x.shape[0], device=x.device) >= drop_prob).nonzero().squeeze(1)
+        # a mask per sample, e.g. of packed sequences, is selected with the samples
+        if attn_mask is not None and attn_mask.size(0) == x.size(0): attn_mask = attn_mask[idxs]
+        return x.index_add(0, idxs, branch(x[idxs], attn_mask).div(1 - drop_prob).to(x.dtype))
+
 
 class PatchEmbed(nn.Module):
     """ Image to Patch Embedding
@@ -164,7 +227,8 @@ class VisionTransformer(nn.Module):
     """ Vision Transformer """
     def __init__(self, img_size=[224], patch_size=16, in_chans=3, num_classes=0, embed_dim=768, depth=12,
                  num_heads=12, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop_rate=0., attn_drop_rate=0.,
-                 drop_path_rate=0., norm_layer=nn.LayerNorm, **kwargs):
+                 drop_path_rate=0., norm_layer=nn.LayerNorm, attn_mode='fused', attn_chunk_size=128,
+                 skip_dropped=False, **kwargs):
         super().__init__()
         self.num_features = self.embed_dim = embed_dim
 
@@ -180,7 +244,8 @@ class VisionTransformer(nn.Module):
         self.blocks = nn.ModuleList([
             Block(
                 dim=embed_dim, num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
-                drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer)
+                drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer,
+                attn_mode=attn_mode, chunk_size=attn_chunk_size, skip_dropped=skip_dropped)
             for i in range(depth)])
         self.norm = norm_layer(embed_dim)
 
@@ -189,6 +254,7 @@ class VisionTransformer(nn.Module):
 
         trunc_normal_(self.pos_embed, std=.02)
         trunc_normal_(self.cls_token, std=.02)
+        self._interp_cache = {}
         self.apply(self._init_weights)
 
     def _init_weights(self, m):
@@ -200,29 +266,48 @@ class VisionTransformer(nn.Module):
             nn.init.constant_(m.bias, 0)
             nn.init.constant_(m.weight, 1.0)
 
+    def _interpolation_matrix(self, w0, h0):
+        "Bicubic interpolation of the patch position table to a w0 x h0 grid as a (w0*h0, N) matrix, cached per grid"
+        key = (w0, h0, self.pos_embed.device, self.pos_embed.dtype)
+        if key not in self._interp_cache:
+            N = self.pos_embed.shape[1] - 1
+            n = int(math.sqrt(N))
+            # interpolation is linear in the table, interpolating each basis vector gives a column of the map.
+            # The map is a normal tensor even if it is first built under `inference_mode`, e.g. by `embed`
+            with torch.inference_mode(False), torch.no_grad():
+                basis = torch.eye(N, device=self.pos_embed.device, dtype=self.pos_embed.dtype).reshape(N, 1, n, n)
+                # we add a small number to avoid floating point error in the interpolation
+                # see discussion at https://github.com/facebookresearch/dino/issues/8
+                m = nn.functional.interpolate(basis, scale_factor=((w0 + 0.1) / n, (h0 + 0.1) / n), mode='bicubic')
+                assert w0 == m.shape[-2] and h0 == m.shape[-1]
+                self._interp_cache[key] = m.reshape(N, -1).t().contiguous()
+        return self._interp_cache[key]
+
     def interpolate_pos_encoding(self, x, w, h):
         npatch = x.shape[1] - 1
         N = self.pos_embed.shape[1] - 1
         if npatch == N and w == h:
             return self.pos_embed
-        class_pos_embed = self.pos_embed[:, 0]
-        patch_pos_embed = self.pos_embed[:, 1:]
-        dim = x.shape[-1]
         w0 = w // self.patch_embed.patch_size
         h0 = h // self.patch_embed.patch_size
-        # we add a small number to avoid floating point error in the interpolation
-        # see discussion at https://github.com/facebookresearch/dino/issues/8
-        w0, h0 = w0 + 0.1, h0 + 0.1
-        patch_pos_embed = nn.functional.interpolate(
-            patch_pos_embed.reshape(1, int(math.sqrt(N)), int(math.sqrt(N)), dim).permute(0, 3, 1, 2),
-            scale_factor=(w0 / math.sqrt(N), h0 / math.sqrt(N)),
-            mode='bicubic',
-        )
-        assert int(w0) == patch_pos_embed.shape[-2] and int(h0) == patch_pos_embed.shape[-1]
-        patch_pos_embed = patch_pos_embed.permute(0, 2, 3, 1).view(1, -1, dim)
-        return torch.cat((class_pos_embed.unsqueeze(0), patch_pos_embed), dim=1)
-
-    def prepare_tokens(self, x):
+        patch_pos_embed = self._interpolation_matrix(w0, h0) @ self.pos_embed[0, 1:]
+        return torch.cat((self.pos_embed[:, :1], patch_pos_embed.unsqueeze(0)), dim=1)
+
+    def drop_tokens(self, x, keep_ratio=1., mask=None):
+        "Keep the [CLS] token and a random `keep_ratio` of the patch tokens of each sample, or the patch tokens where `mask` is False"
+        cls_tokens, x = x[:, :1], x[:, 1:]
+        B, N, C = x.shape
+        if mask is None:
+            n_keep = max(1, int(N * keep_ratio))
+            idxs = torch.rand(B, N, device=x.device).argsort(dim=1)[:, :n_keep]
+        else:
+            n_keep = (~mask).sum(1)
+            assert (n_keep == n_keep[0]).all(), "mask needs to drop the same number of tokens of each sample"
+            idxs = (~mask).nonzero()[:, 1].view(B, -1)
+        x = x.gather(1, idxs.unsqueeze(-1).expand(-1, -1, C))
+        return torch.cat((cls_tokens, x), dim=1)
+
+    def prepare_tokens(self, x, keep_ratio=1., mask=None):
         B, nc, w, h = x.shape
         x = self.patch_embed(x)  # patch linear embedding
 
@@ -233,14 +318,63 @@ class VisionTransformer(nn.Module):
         # add positional encoding to each token
         x = x + self.interpolate_pos_encoding(x, w, h)
 
+        # drop patch tokens after they know their position, blocks only see the kept tokens
+        if keep_ratio < 1. or mask is not None: x = self.drop_tokens(x, keep_ratio, mask)
+
         return self.pos_drop(x)
 
-    def forward(self, x):
-        x = self.prepare_tokens(x)
+    def forward(self, x, keep_ratio=1., mask=None):
+        x = self.prepare_tokens(x, keep_ratio, mask)
         for blk in self.blocks:
             x = blk(x)
-        x = self.norm(x)
-        return x[:, 0]
+        # LayerNorm is applied per token, only the [CLS] token is needed
+        return self.norm(x[:, 0])
+
+    def pack_tokens(self, xs):
+        """
+        Pack the tokens of the crops in `xs`, a batch of crops per resolution, into sequences of the length of the longest
+        crop. Returns the packed tokens, a mask of the tokens each token attends to, the index of each crop's [CLS] token
+        in the flattened sequences and for each token the index of its crop's [CLS] token, -1 for padding.
+        """
+        L = max(x.size(1) for x in xs)
+        seqs, crop_ids, cls_idxs, n_seqs = [], [], [], 0
+        for x in xs:
+            B, N, C = x.shape
+            k = L // N  # crops per sequence
+            S = -(-B // k)
+            # pad the batch to full sequences and each sequence to L tokens, padding forms a segment of its own
+            x = nn.functional.pad(x, (0, 0, 0, 0, 0, S * k - B)).reshape(S, k * N, C)
+            seqs.append(nn.functional.pad(x, (0, 0, 0, L - k * N)))
+            # a crop is identified by the position of its [CLS] token
+            ids = (n_seqs + torch.arange(S, device=x.device)).unsqueeze(1) * L + torch.arange(k, device=x.device) * N
+            ids = ids.repeat_interleave(N, dim=1)
+            crop_ids.append(nn.functional.pad(ids, (0, L - k * N), value=-1))
+            b = torch.arange(B, device=x.device)
+            cls_idxs.append((n_seqs + b // k) * L + (b % k) * N)
+            n_seqs += S
+        crop_ids = torch.cat(crop_ids)
+        # tokens only attend to the tokens of their own crop
+        attn_mask = (crop_ids.unsqueeze(2) == crop_ids.unsqueeze(1)).unsqueeze(1)
+        return torch.cat(seqs), attn_mask, torch.cat(cls_idxs), crop_ids
+
+    def forward_packed(self, xs, keep_ratio=1.):
+        "[CLS] embeddings of a list of batches of crops of different resolutions with a single pass through the blocks"
+        xs = [self.prepare_tokens(x, keep_ratio if i == 0 else 1.) for i, x in enumerate(xs)]
+        x, attn_mask, cls_idxs, crop_ids = self.pack_tokens(xs)
+        for blk in self.blocks:
+            x = blk(x, attn_mask=attn_mask, crop_ids=crop_ids)
+        return self.norm(x.flatten(0, 1)[cls_idxs])
+
+    @torch.inference_mode()
+    def embed(self, x, bs=64, out=None):
+        "[CLS] embeddings of `x` in eval mode, computed in batches of `bs` and written into `out` if given"
+        out = x.new_empty(len(x), self.num_features) if out is None else out
+        training = self.training
+        self.eval()
+        try:
+            for i in range(0, len(x), bs): out[i:i+bs] = self(x[i:i+bs])
+        finally: self.train(training)
+        return out
 
     def get_last_selfattention(self, x):
         x = self.prepare_tokens(x)
@@ -271,9 +405,15 @@ class MultiCropWrapper(nn.Module):
     concatenate all the output features and run the head forward on these
     concatenated features.
     """
-    def __init__(self, encoder):
+    def __init__(self, encoder, keep_ratio=1., packed=False):
+        """
+            keep_ratio: Ratio of patch tokens a `VisionTransformer` encoder keeps for the first resolution, e.g. the
+                        global crops, during training.
+            packed:     Pack the tokens of all resolutions into sequences of the same length and run a
+                        `VisionTransformer` encoder once with `forward_packed` instead of once per resolution.
+        """
         super(MultiCropWrapper, self).__init__()
-        self.encoder = encoder
+        self.encoder, self.keep_ratio, self.packed = encoder, keep_ratio, packed
 
     def forward(self, x):
         # convert to list
@@ -283,14 +423,19 @@ class MultiCropWrapper(nn.Module):
             torch.tensor([inp.shape[-1] for inp in x]),
             return_counts=True,
         )[1], 0)
-        start_idx = 0
+        keep_ratio = self.keep_ratio if self.training else 1.
+        if self.packed:
+            xs = [torch.cat(x[start_idx: end_idx]) for start_idx, end_idx in zip([0] + idx_crops[:-1].tolist(), idx_crops)]
+            return self.encoder.forward_packed(xs, keep_ratio)
+        start_idx, offset = 0, 0
         for end_idx in idx_crops:
-            _out = self.encoder(torch.cat(x[start_idx: end_idx]))
+            kwargs = {'keep_ratio': keep_ratio} if start_idx == 0 and keep_ratio < 1. else {}
+            _out = self.encoder(torch.cat(x[start_idx: end_idx]), **kwargs)
+            # write the features of each resolution into a single output instead of growing it
             if start_idx == 0:
-                output = _out
-            else:
-                output = torch.cat((output, _out))
-            start_idx = end_idx
+                output = _out.new_empty((sum(len(inp) for inp in x), *_out.shape[1:]))
+            output[offset: offset + len(_out)] = _out
+            start_idx, offset = end_idx, offset + len(_out)
         # Run the head forward on the concatenated features.
         return output
 
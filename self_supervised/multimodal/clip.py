@@ -470,8 +470,7 @@ class CLIPTrainer(Callback):
 
     def lf(self, pred, *yb):
         image_features, text_features = pred
-        if num_distrib()==0: logit_scale = self.model.logit_scale.exp()
-        else:                logit_scale = self.model.module.logit_scale.exp()
+        logit_scale = get_model(self.model).logit_scale.exp()
         logits_per_image = logit_scale * image_features @ text_features.t()
         logits_per_text = logit_scale * text_features @ image_features.t()
 
@@ -482,42 +481,49 @@ class CLIPTrainer(Callback):
 
     def after_step(self):
         # logit scaling set as max 100
-        if num_distrib()==0: self.model.logit_scale.data = torch.clamp(self.model.logit_scale.data, 0, 4.6052)
-        else:                self.model.module.logit_scale.data = torch.clamp(self.model.module.logit_scale.data, 0, 4.6052)
+        model = get_model(self.model)
+        model.logit_scale.data = torch.clamp(model.logit_scale.data, 0, 4.6052)
 
 # Cell
+from ..dist import all_gather_with_grad, get_rank
+
 class DistributedCLIPTrainer(Callback):
     "Distributed implementation of InfoNCE loss, should be used with DistributedDataParallel"
     order,run_valid = 9,True
+    def __init__(self, local_loss=True, gather_dtype=None):
+        """
+            local_loss:   Compute logits only for the samples of this process against the samples of all processes.
+            gather_dtype: Dtype features are gathered in, e.g. torch.bfloat16 or torch.float16. None keeps their dtype.
+        """
+        store_attr('local_loss,gather_dtype')
 
     def before_fit(self):
         self.learn.loss_func = self.lf
 
-    def lf(self, pred, *yb):
+    def _gather(self, x):
+        "Start gathering `x` from all processes in `gather_dtype`"
+        return all_gather_with_grad(x if self.gather_dtype is None else x.to(self.gather_dtype), async_op=True)
 
+    def lf(self, pred, *yb):
         image_features, text_features = pred
-        logit_scale = self.model.module.logit_scale.exp()
-
-        bs, rank = image_features.size(0), rank_distrib()
-
-        # image loss
-        all_text_features = [torch.zeros_like(text_features) for _ in range(dist.get_world_size())]
-        dist.all_gather(all_text_features, text_features)
-        all_text_features = torch.cat(all_text_features)
-        logits_per_image = logit_scale * image_features @ all_text_features.t()
-        labels = torch.arange(rank*bs, (rank+1)*bs).to(logits_per_image.device)
-        image_loss = F.cross_entropy(logits_per_image, labels)
-
-        # text loss
-        all_image_features = [torch.zeros_like(image_features) for _ in range(dist.get_world_size())]
-        dist.all_gather(all_image_features, image_features)
-        all_image_features = torch.cat(all_image_features)
-        logits_per_text = logit_scale * text_features @ all_image_features.t()
-        labels = torch.arange(rank*bs, (rank+1)*bs).to(logits_per_text.device)
-        text_loss  = F.cross_entropy(logits_per_text, labels)
-
+        logit_scale = get_model(self.model).logit_scale.exp()
+        image_gather, text_gather = self._gather(image_features), self._gather(text_features)
+        all_image_features = image_gather.wait().to(image_features.dtype)
+        all_text_features  = text_gather.wait().to(text_features.dtype)
+
+        if self.local_loss:
+            bs, rank = image_features.size(0), get_rank()
+            labels = torch.arange(rank*bs, (rank+1)*bs, device=image_features.device)
+            image_loss = F.cross_entropy(logit_scale * image_features @ all_text_features.t(), labels)
+            text_loss  = F.cross_entropy(logit_scale * text_features @ all_image_features.t(), labels)
+        else:
+            logits = logit_scale * all_image_features @ all_text_features.t()
+            labels = torch.arange(len(logits), device=logits.device)
+            image_loss = F.cross_entropy(logits, labels)
+            text_loss  = (logits.logsumexp(0) - logits.diagonal()).mean()
         return (image_loss+text_loss)/2
 
     def after_step(self):
         # logit scaling set as max 100
-        self.model.module.logit_scale.data = torch.clamp(self.model.module.logit_scale.data, 0, 4.6052)
\ No newline at end of file
+        model = get_model(self.model)
+        model.logit_scale.data = torch.clamp(model.logit_scale.data, 0, 4.6052)
\ No newline at end of file
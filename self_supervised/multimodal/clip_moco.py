@@ -8,6 +8,7 @@ __all__ = ['ClipTokenizer', 'vitb32_config', 'vitl14_config', 'Bottleneck', 'Att
 from fastai.vision.all import *
 from ..augmentations import *
 from ..layers import *
+from ..ema import *
 
 # Cell
 try:
@@ -374,11 +375,14 @@ class CLIPMOCO(nn.Module):
         for param_k in self.transformer_key_encoder.parameters(): param_k.requires_grad = False
         self.text_projection_key_encoder = deepcopy(self.text_projection)
         self.text_projection_key_encoder.requires_grad = False
+        self.key_ema = EMA([*self.visual.parameters(), *self.transformer.parameters(), self.text_projection],
+                           [*self.visual_key_encoder.parameters(), *self.transformer_key_encoder.parameters(),
+                            self.text_projection_key_encoder])
 
         # init queues
-        self.image_queue = torch.randn(self.K, embed_dim)
-        self.text_queue = torch.randn(self.K, embed_dim)
-        self.queue_ptr = 0
+        self.image_queue = FeatureQueue(self.K, embed_dim, normalize=False, gather=True)
+        self.text_queue = FeatureQueue(self.K, embed_dim, normalize=False, gather=True)
+        ddp_ignore_queues(self)
 
 
     def initialize_parameters(self):
@@ -443,23 +447,13 @@ class CLIPMOCO(nn.Module):
 
 
     @torch.no_grad()
-    def _momentum_update_key_encoders(self):
-        for param_q, param_k in zip(self.visual.parameters(), self.visual_key_encoder.parameters()):
-            param_k.data = param_k.data * self.m + param_q.data * (1. - self.m)
-
-        for param_q, param_k in zip(self.transformer.parameters(), self.transformer_key_encoder.parameters()):
-            param_k.data = param_k.data * self.m + param_q.data * (1. - self.m)
-
-        self.text_projection_key_encoder.data = self.text_projection_key_encoder.data * self.m + self.text_projection.data * (1. - self.m)
+    def _momentum_update_key_encoders(self): self.key_ema.update(self.m)
 
 
     @torch.no_grad()
     def _dequeue_and_enqueue(self, image_k, text_k):
-        bs = image_k.size(0)
-        assert self.K % bs == 0  # for simplicity
-        self.image_queue[self.queue_ptr:self.queue_ptr+bs, :] = image_k
-        self.text_queue[self.queue_ptr:self.queue_ptr+bs, :] = text_k
-        self.queue_ptr = (self.queue_ptr + bs) % self.K  # move pointer
+        self.image_queue.enqueue(image_k)
+        self.text_queue.enqueue(text_k)
 
 
     @torch.no_grad()
@@ -563,7 +557,8 @@ class CLIPMOCOTrainer(Callback):
 
         # queues update
         key_image_features, key_text_features = self.learn.yb
-        self.learn.model._dequeue_and_enqueue(key_image_features, key_text_features)
+        model = get_model(self.model)
+        model._dequeue_and_enqueue(key_image_features, key_text_features)
 
         # momentum update
-        self.learn.model._momentum_update_key_encoders()
\ No newline at end of file
+        model._momentum_update_key_encoders()
\ No newline at end of file
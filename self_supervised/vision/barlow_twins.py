@@ -1,6 +1,7 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/14 - barlow_twins.ipynb (unless otherwise specified).
 
-__all__ = ['BarlowTwinsModel', 'create_barlow_twins_model', 'get_barlow_twins_aug_pipelines', 'BarlowTwins']
+__all__ = ['BarlowTwinsModel', 'create_barlow_twins_model', 'get_barlow_twins_aug_pipelines', 'barlow_twins_loss',
+           'BarlowTwins']
 
 # Cell
 from fastai.vision.all import *
@@ -26,18 +27,45 @@ def create_barlow_twins_model(encoder, hidden_size=256, projection_size=128, bn=
 @delegates(get_multi_aug_pipelines)
 def get_barlow_twins_aug_pipelines(size, **kwargs): return get_multi_aug_pipelines(n=2, size=size, **kwargs)
 
+# Cell
+from torch.utils.checkpoint import checkpoint
+
+def _sq_norm_chunk(z1, z2): return (z1.T @ z2).pow(2).sum()
+
+
+def _corr_sq_norm(z1, z2, chunk_size=None):
+    "Squared Frobenius norm of `z1.T @ z2`"
+    bs, nf = z1.shape
+    if chunk_size is None and bs < nf: return ((z1 @ z1.T) * (z2 @ z2.T)).sum()
+    if chunk_size is None or chunk_size >= nf: return _sq_norm_chunk(z1, z2)
+    return sum(checkpoint(_sq_norm_chunk, z1[:, i:i+chunk_size], z2, use_reentrant=False) for i in range(0, nf, chunk_size))
+
+
+def barlow_twins_loss(z1, z2, lmb, chunk_size=None):
+    "Barlow Twins loss of the embeddings of two views without materializing masks of the cross-correlation matrix"
+    bs = z1.size(0)
+    # sums over all entries of `C` overflow in half precision, so they are computed in float32 also under autocast
+    with torch.autocast(z1.device.type, enabled=False):
+        z1, z2 = z1.float(), z2.float()
+        z1 = (z1 - z1.mean(0)) / z1.std(0, unbiased=False)
+        z2 = (z2 - z2.mean(0)) / z2.std(0, unbiased=False)
+        c_diag = (z1*z2).sum(0) / bs
+        off_diag = _corr_sq_norm(z1, z2, chunk_size) / bs**2 - c_diag.pow(2).sum()
+        return (1 - c_diag).pow(2).sum() + lmb*off_diag
+
 # Cell
 class BarlowTwins(Callback):
     order,run_valid = 9,True
-    def __init__(self, aug_pipelines, lmb=5e-3, print_augs=False):
+    def __init__(self, aug_pipelines, lmb=5e-3, print_augs=False, memory_efficient=False, chunk_size=None):
         assert_aug_pipelines(aug_pipelines)
         self.aug1, self.aug2 = aug_pipelines
         if print_augs: print(self.aug1), print(self.aug2)
-        store_attr('lmb')
+        store_attr('lmb,memory_efficient,chunk_size')
 
 
     def before_fit(self):
         self.learn.loss_func = self.lf
+        if self.memory_efficient: return
         nf = self.learn.model.projector[-1].out_features
         self.I = torch.eye(nf).to(self.dls.device)
 
@@ -50,6 +78,7 @@ class BarlowTwins(Callback):
     def lf(self, pred, *yb):
         bs,nf = pred.size(0)//2,pred.size(1)
         z1, z2 = pred[:bs],pred[bs:]
+        if self.memory_efficient: return barlow_twins_loss(z1, z2, self.lmb, self.chunk_size)
 
         z1norm = (z1 - z1.mean(0)) / z1.std(0, unbiased=False)
         z2norm = (z2 - z2.mean(0)) / z2.std(0, unbiased=False)
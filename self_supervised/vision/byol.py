@@ -6,21 +6,32 @@ __all__ = ['BYOLModel', 'create_byol_model', 'get_byol_aug_pipelines', 'BYOL']
 from fastai.vision.all import *
 from ..augmentations import *
 from ..layers import *
+from ..ema import *
+from contextlib import nullcontext
 
 # Cell
 class BYOLModel(Module):
     "Compute predictions of v1 and v2"
-    def __init__(self,encoder,projector,predictor):
+    def __init__(self,encoder,projector,predictor,fused=False,split_bn=True):
         self.encoder,self.projector,self.predictor = encoder,projector,predictor
+        store_attr('fused,split_bn')
+
+    def _both_views(self, f, v1, v2):
+        "Apply `f` to each view, or once to both views concatenated if `fused`"
+        if not self.fused: return (f(v1), f(v2))
+        with split_batchnorm(self, 2) if self.split_bn else nullcontext():
+            return f(torch.cat([v1,v2])).chunk(2)
 
     def forward(self,v1,v2):
         "Symmetric predictions for symmetric loss calc"
-        q1 = self.predictor(self.projector(self.encoder(v1)))
-        q2 = self.predictor(self.projector(self.encoder(v2)))
-        return (q1,q2)
+        return self._both_views(lambda v: self.predictor(self.projector(self.encoder(v))), v1, v2)
+
+    def project(self,v1,v2):
+        "Symmetric projections, used as targets by the target model"
+        return self._both_views(lambda v: self.projector(self.encoder(v)), v1, v2)
 
 # Cell
-def create_byol_model(encoder, hidden_size=4096, projection_size=256, bn=True, nlayers=2):
+def create_byol_model(encoder, hidden_size=4096, projection_size=256, bn=True, nlayers=2, fused=False, split_bn=True):
     "Create BYOL model"
     n_in  = in_channels(encoder)
     with torch.no_grad(): representation = encoder(torch.randn((2,n_in,128,128)))
@@ -28,7 +39,7 @@ def create_byol_model(encoder, hidden_size=4096, projection_size=256, bn=True, n
     predictor = create_mlp_module(projection_size, hidden_size, projection_size, bn=bn, nlayers=nlayers)
     apply_init(projector)
     apply_init(predictor)
-    return BYOLModel(encoder, projector, predictor)
+    return BYOLModel(encoder, projector, predictor, fused=fused, split_bn=split_bn)
 
 # Cell
 @delegates(get_multi_aug_pipelines)
@@ -41,6 +52,7 @@ class BYOL(Callback):
     order,run_valid = 9,True
     def __init__(self, aug_pipelines, m=0.999, print_augs=False):
         assert_aug_pipelines(aug_pipelines)
+        self.augs = aug_pipelines
         self.aug1, self.aug2 = aug_pipelines
         if print_augs: print(self.aug1), print(self.aug2)
         store_attr("m")
@@ -49,19 +61,18 @@ class BYOL(Callback):
         "Create target model"
         self.target_model = deepcopy(self.learn.model).to(self.dls.device)
         for param_k in self.target_model.parameters(): param_k.requires_grad = False
+        self.ema = EMA(self.learn.model, self.target_model)
         self.learn.loss_func = self.lf
 
     def before_train(self):    self.target_model.train()
     def before_validate(self): self.target_model.eval()
     def before_batch(self):
         "Generate 2 views of the same image and calculate target projections for these views"
-        v1,v2 = self.aug1(self.x), self.aug2(self.x.clone())
+        if isinstance(self.augs, MultiViewAugmentation): v1,v2 = self.augs(self.x)
+        else:                                            v1,v2 = self.aug1(self.x), self.aug2(self.x.clone())
         self.learn.xb = (v1,v2)
 
-        with torch.no_grad():
-            z1 = self.target_model.projector(self.target_model.encoder(v1))
-            z2 = self.target_model.projector(self.target_model.encoder(v2))
-            self.learn.yb = (z1,z2)
+        with torch.no_grad(): self.learn.yb = self.target_model.project(v1,v2)
 
 
     def _mse_loss(self, x, y):
@@ -75,9 +86,7 @@ class BYOL(Callback):
 
 
     @torch.no_grad()
-    def _momentum_update_target_encoder(self):
-        for param_q, param_k in zip(self.learn.model.parameters(), self.target_model.parameters()):
-            param_k.data = param_k.data * self.m + param_q.data * (1. - self.m)
+    def _momentum_update_target_encoder(self): self.ema.update(self.m)
 
 
     def after_step(self):
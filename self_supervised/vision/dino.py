@@ -1,11 +1,12 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/15 - dino.ipynb (unless otherwise specified).
 
-__all__ = ['DINOHead', 'get_dino_aug_pipelines', 'DINOModel', 'DINO']
+__all__ = ['DINOHead', 'get_dino_aug_pipelines', 'DINOModel', 'dino_loss', 'DINO', 'DistributedDINO']
 
 # Cell
 from fastai.vision.all import *
 from ..augmentations import *
 from ..layers import *
+from ..ema import *
 from ..models.vision_transformer import *
 
 # Cell
@@ -55,7 +56,8 @@ class DINOHead(nn.Module):
 
 # Cell
 @delegates(get_multi_aug_pipelines, but=['n', 'size', 'resize_scale'])
-def get_dino_aug_pipelines(num_crops=(2,4), crop_sizes=(224,96), min_scales=(0.4,0.05), max_scales=(1.,0.4), **kwargs):
+def get_dino_aug_pipelines(num_crops=(2,4), crop_sizes=(224,96), min_scales=(0.4,0.05), max_scales=(1.,0.4), vectorized=False, **kwargs):
+    if vectorized: return MultiViewAugmentation(num_crops, crop_sizes, min_scales, max_scales, **kwargs)
     aug_pipelines = []
     for nc, size, mins, maxs in zip(num_crops, crop_sizes, min_scales, max_scales):
         aug_pipelines += get_multi_aug_pipelines(n=nc, size=size, resize_scale=(mins,maxs), **kwargs)
@@ -71,6 +73,43 @@ class DINOModel(Module):
         self.register_buffer('C',  torch.zeros(1,num_features_model(teacher)))
     def forward(self,x): return self.student(x)
 
+# Cell
+def _dino_weights(targs, targ_sum, i): return targ_sum - targs[i] if i < len(targs) else targ_sum
+
+
+class _DINOLoss(torch.autograd.Function):
+    "Summed cross entropy of all pairs of different crops, computed one student crop at a time"
+    @staticmethod
+    def forward(ctx, pred, targ, bs, tps):
+        # sums over bs*K entries overflow in half precision, so the loss is computed in float32 also under autocast
+        with torch.autocast(pred.device.type, enabled=False):
+            targs = targ.float().view(-1, bs, targ.size(-1))
+            targ_sum, loss = targs.sum(0), pred.new_zeros((), dtype=torch.float32)
+            for i, p in enumerate(pred.split(bs)):
+                w, s = _dino_weights(targs, targ_sum, i), p.float() / tps
+                loss += w.view(-1) @ s.view(-1) - w.sum(-1) @ s.logsumexp(-1)
+        ctx.save_for_backward(pred, targ)
+        ctx.bs, ctx.tps = bs, tps
+        return loss
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad):
+        pred, targ = ctx.saved_tensors
+        with torch.autocast(pred.device.type, enabled=False):
+            targs = targ.float().view(-1, ctx.bs, targ.size(-1))
+            targ_sum, out = targs.sum(0), torch.empty_like(pred)
+            for i, (p, g) in enumerate(zip(pred.split(ctx.bs), out.split(ctx.bs))):
+                w = _dino_weights(targs, targ_sum, i)
+                g.copy_(torch.softmax(p.float() / ctx.tps, dim=-1).mul_(-w.sum(-1, keepdim=True)).add_(w).mul_(grad / ctx.tps))
+        return out, None, None, None
+
+
+def dino_loss(pred, targ, bs, tps):
+    "Mean cross entropy of all pairs of different crops between teacher probabilities `targ` and student logits `pred`"
+    n_targs, n_preds = targ.size(0)//bs, pred.size(0)//bs
+    return -_DINOLoss.apply(pred, targ.detach(), bs, tps) / (bs*n_targs*(n_preds-1))
+
 # Cell
 class DINO(Callback):
     order,run_valid = 9,True
@@ -80,6 +119,7 @@ class DINO(Callback):
                          tpt_start=0.04, tpt_end=0.04, tpt_warmup_pct=0., tpt_sched=SchedLin,
                          tps=0.1,
                          freeze_last_layer=1,
+                         student_keep_ratio=1.,
                          print_augs=False):
         """
         DINO teacher student training with distillation.
@@ -94,8 +134,10 @@ class DINO(Callback):
                             Smaller temperature means more sharpening.
             tps:            Student temperature.
             freeze_last_layer: How many epochs to freeze the last layer
+            student_keep_ratio: Ratio of patch tokens the student keeps for the global crops, requires a
+                            `MultiCropWrapper` with a `VisionTransformer` encoder. Smaller is faster.
         """
-        store_attr('large_crop_ids,cmom,freeze_last_layer,tps')
+        store_attr('large_crop_ids,cmom,freeze_last_layer,tps,student_keep_ratio')
         self.augs = aug_pipelines
         self.tpt_scheduler  = combine_scheds([tpt_warmup_pct,1-tpt_warmup_pct],
                                              [tpt_sched(tpt_start,tpt_end),SchedNo(tpt_end,tpt_end)])
@@ -110,6 +152,8 @@ class DINO(Callback):
         self.tpt  = self.tpt_scheduler(0.)
         self.tmom = self.tmom_scheduler(0.)
         self.model.teacher.eval()
+        self.ema = EMA(self.learn.model.student, self.model.teacher)
+        if self.student_keep_ratio < 1.: get_model(self.model).student[0].keep_ratio = self.student_keep_ratio
 
         for n,p in self.learn.model.student[1].last_layer.named_parameters():
             if n == 'weight_v' : p.requires_grad = False
@@ -118,23 +162,26 @@ class DINO(Callback):
     def before_batch(self):
         "Augment multi crop views"
         self.bs = self.x.size(0)
-        self.learn.xb = ([aug(self.x) for aug in self.augs],)
+        if isinstance(self.augs, MultiViewAugmentation): self.learn.xb = (self.augs(self.x),)
+        else:                                            self.learn.xb = ([aug(self.x) for aug in self.augs],)
         x_large = [self.learn.xb[0][i] for i in self.large_crop_ids]
 
         # TODO: Do we need to put the teacher in eval(), not it original repo?
         with torch.no_grad():
-            targs = self.model.teacher(x_large)
+            targs = get_model(self.model).teacher(x_large)
             self.learn.yb = (targs,)
-            self.cb       = targs.mean(0, keepdim=True)
+            self.cb       = self._batch_center(targs)
 
 
-    def _momentum_update_teacher(self):
-        for param_s, param_t in zip(self.learn.model.student.parameters(), self.model.teacher.parameters()):
-            param_t.data = param_t.data * self.tmom + param_s.data * (1. - self.tmom)
+    def _batch_center(self, targs): return targs.mean(0, keepdim=True)
+
+
+    def _momentum_update_teacher(self): self.ema.update(self.tmom)
 
 
     def _momentum_update_center(self):
-        self.model.C = self.model.C*self.cmom + self.cb*(1-self.cmom)
+        model = get_model(self.model)
+        model.C = model.C*self.cmom + self.cb*(1-self.cmom)
 
 
     def after_step(self):
@@ -149,25 +196,14 @@ class DINO(Callback):
 
         if self.epoch == self.freeze_last_layer:
             print("Setting last layer to trainable")
-            for n,p in self.learn.model.student[1].last_layer.named_parameters():
+            for n,p in get_model(self.learn.model).student[1].last_layer.named_parameters():
                 if n == 'weight_v' : p.requires_grad = True
 
 
     def lf(self, pred, *yb):
         "Multi crop cross entropy loss: -qlog(p)"
-        yb = yb[0]
-        pred = F.log_softmax(pred / self.tps, dim=-1)
-        yb   = F.softmax((yb - self.model.C) / self.tpt, dim=-1)
-
-        n_targs, n_preds = yb.size(0)//self.bs, pred.size(0)//self.bs
-        yb, pred = yb.chunk(n_targs), pred.chunk(n_preds)
-
-        loss, npairs = 0, n_targs*(n_preds-1)
-        for ti in range(n_targs):
-            for pi in range(n_preds):
-                if ti != pi:
-                    loss += (-yb[ti]*pred[pi]).sum(-1).mean() / npairs
-        return loss
+        yb = F.softmax((yb[0] - get_model(self.model).C) / self.tpt, dim=-1)
+        return dino_loss(pred, yb, self.bs, self.tps)
 
 
 
@@ -178,4 +214,11 @@ class DINO(Callback):
         images = [aug.decode(xb.to('cpu').clone()).clamp(0, 1)[i]
                   for i in idxs
                   for xb, aug in zip(xbs, self.augs)]
-        return show_batch(images[0], None, images, max_n=len(images), nrows=n)
\ No newline at end of file
+        return show_batch(images[0], None, images, max_n=len(images), nrows=n)
+
+# Cell
+from ..dist import all_reduce
+
+class DistributedDINO(DINO):
+    "DINO with the teacher center updated over the global batch"
+    def _batch_center(self, targs): return all_reduce(targs.mean(0, keepdim=True), 'mean')
\ No newline at end of file
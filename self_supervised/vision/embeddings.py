@@ -0,0 +1,88 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/71 - vision.embeddings.ipynb (unless otherwise specified).
+
+__all__ = ['MemmapEmbeddingBank', 'extract_embeddings']
+
+# Cell
+from fastai.vision.all import *
+import json
+
+# Cell
+class MemmapEmbeddingBank:
+    "Fixed size on-disk embedding store backed by `np.memmap` with an id index and a resumable write position"
+    def __init__(self, path, mode='r+'):
+        "Open an existing bank at `path`"
+        self.path = Path(path)
+        self.meta = json.loads((self.path/'meta.json').read_text())
+        self.embs = np.load(self.path/'embs.npy', mmap_mode=mode)
+        self.ids  = np.load(self.path/'ids.npy',  mmap_mode=mode)
+
+    @classmethod
+    def create(cls, path, n, dim, dtype='float16'):
+        "Create an empty bank with capacity for `n` embeddings of size `dim`"
+        path = Path(path); path.mkdir(parents=True, exist_ok=True)
+        np.lib.format.open_memmap(path/'embs.npy', mode='w+', dtype=np.dtype(dtype), shape=(n, dim))
+        np.lib.format.open_memmap(path/'ids.npy',  mode='w+', dtype=np.int64, shape=(n,))
+        (path/'meta.json').write_text(json.dumps(dict(n=n, dim=dim, dtype=str(np.dtype(dtype)), count=0)))
+        return cls(path)
+
+    @classmethod
+    def exists(cls, path): return (Path(path)/'meta.json').exists()
+
+    @property
+    def count(self): return self.meta['count']
+    @property
+    def complete(self): return self.count == self.meta['n']
+    def __len__(self): return self.count
+
+    def write(self, embs, ids):
+        "Append a batch of `embs` with their `ids` after the last written row"
+        embs, ids = to_np(to_detach(embs, gather=False)), np.asarray(ids)
+        c = self.count
+        assert c + len(embs) <= self.meta['n'], "Bank is full"
+        self.embs[c:c+len(embs)] = embs.astype(self.embs.dtype)
+        self.ids[c:c+len(embs)] = ids
+        self.meta['count'] = c + len(embs)
+
+    def flush(self):
+        "Persist written rows, then the row count, so that a crash never records rows which are not on disk"
+        self.embs.flush(); self.ids.flush()
+        tmp = self.path/'meta.json.tmp'
+        tmp.write_text(json.dumps(self.meta))
+        os.replace(tmp, self.path/'meta.json')
+
+    def tensor(self):
+        "Zero-copy torch view of the written embeddings"
+        return torch.from_numpy(np.load(self.path/'embs.npy', mmap_mode='c')[:self.count])
+
+    def ids_tensor(self):
+        "Zero-copy torch view of the dataset ids of the written embeddings"
+        return torch.from_numpy(np.load(self.path/'ids.npy', mmap_mode='c')[:self.count])
+
+# Cell
+def _range_idxs(start, n): return list(range(start, n))
+
+
+@torch.no_grad()
+def extract_embeddings(encoder, dl, path, dtype='float16', flush_every=50):
+    "Write `encoder` embeddings of all samples in `dl` to a `MemmapEmbeddingBank` at `path`, resuming if it exists"
+    bank = MemmapEmbeddingBank(path) if MemmapEmbeddingBank.exists(path) else None
+    n = len(dl.dataset)
+    if bank is not None:
+        assert bank.meta['n'] == n, f"Existing bank at {path} has {bank.meta['n']} rows but dataset has {n} samples"
+        if bank.complete: return bank
+    start = 0 if bank is None else bank.count
+    # a new loader over the remaining samples, `partial` keeps it picklable for spawned workers
+    dl = dl.new(shuffle=False, drop_last=False, get_idxs=partial(_range_idxs, start, n))
+    training = encoder.training
+    encoder.eval()
+    try:
+        i = start
+        for bi,b in enumerate(progress_bar(dl, total=math.ceil((n-start)/dl.bs), leave=False)):
+            embs = encoder(b[0])
+            if bank is None: bank = MemmapEmbeddingBank.create(path, n, embs.size(1), dtype)
+            bank.write(embs, np.arange(i, i+len(embs)))
+            i += len(embs)
+            if (bi+1) % flush_every == 0: bank.flush()
+    finally: encoder.train(training)
+    bank.flush()
+    return bank
\ No newline at end of file
@@ -1,32 +1,101 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/70 - vision.metrics.ipynb (unless otherwise specified).
 
-__all__ = ['KNNProxyMetric']
+__all__ = ['EmbeddingBank', 'knn_classify', 'KNNProxyMetric']
 
 # Cell
 from fastai.vision.all import *
 
+# Cell
+class EmbeddingBank:
+    "Preallocated storage for normalized embeddings and labels, capacity grows geometrically when full"
+    def __init__(self, capacity=1024, device=None, normalize=True):
+        store_attr('capacity,device,normalize')
+        self.n, self._embs, self._targs = 0, None, None
+
+    def _grow(self, size):
+        self.capacity = max(2*self.capacity, size)
+        embs = self._embs.new_empty(self.capacity, self._embs.size(1))
+        targs = self._targs.new_empty(self.capacity)
+        embs[:self.n], targs[:self.n] = self._embs[:self.n], self._targs[:self.n]
+        self._embs, self._targs = embs, targs
+
+    @torch.no_grad()
+    def add(self, embs, targs):
+        "Add a batch of embeddings and labels"
+        embs = cast(embs.detach(), Tensor).to(self.device, torch.float32)
+        targs = cast(targs.detach(), Tensor).to(self.device).long()
+        if self.normalize: embs = F.normalize(embs, dim=1)
+        if self._embs is None:
+            self._embs = embs.new_empty(self.capacity, embs.size(1))
+            self._targs = targs.new_empty(self.capacity)
+        if self.n + len(embs) > self.capacity: self._grow(self.n + len(embs))
+        self._embs[self.n:self.n+len(embs)] = embs
+        self._targs[self.n:self.n+len(embs)] = targs
+        self.n += len(embs)
+
+    @property
+    def embs(self): return self._embs[:self.n]
+    @property
+    def targs(self): return self._targs[:self.n]
+
+# Cell
+@torch.no_grad()
+def knn_classify(query, bank, bank_targs, k=1, temp=0.07, weighted=True, n_classes=None, chunk_size=1024, exclude_self=False):
+    "Predict labels of normalized `query` embeddings by kNN voting over normalized `bank` embeddings"
+    n_classes = ifnone(n_classes, int(bank_targs.max())+1)
+    k = min(k, len(bank) - int(exclude_self))
+    preds = torch.empty(len(query), dtype=torch.long, device=query.device)
+    for i in range(0, len(query), chunk_size):
+        sim = query[i:i+chunk_size] @ bank.T
+        if exclude_self: sim.diagonal(i).fill_(float('-inf'))
+        sim, idxs = sim.topk(k, dim=1)
+        # weights relative to the nearest neighbor in float32, `exp(1/temp)` overflows in half precision
+        w = ((sim.float() - sim[:, :1].float()) / temp).exp() if weighted else torch.ones_like(sim, dtype=torch.float32)
+        votes = w.new_zeros(len(sim), n_classes).scatter_add_(1, bank_targs[idxs], w)
+        preds[i:i+chunk_size] = votes.argmax(1)
+    return preds
+
 # Cell
 class KNNProxyMetric(Callback):
-    "A metric which calculates knn-1 accuracy. Use with a labeled validation set."
+    "A metric which calculates kNN accuracy. Use with a labeled validation set."
     order,run_train,run_valid=8,False,True
+    def __init__(self, k=1, temp=0.07, weighted=True, chunk_size=1024, bank_dl=None):
+        """
+            k:          Number of neighbors which vote for the label of each validation sample.
+            temp:       Temperature of the `exp(sim/temp)` vote weights.
+            weighted:   Use similarity weighted votes, otherwise each neighbor gets one vote.
+            chunk_size: Number of queries to compute similarities for at once, bounds memory to chunk_size×len(bank).
+            bank_dl:    Optional labeled `DataLoader`, e.g. the training set, to search neighbors in. By default
+                        neighbors come from the rest of the validation set.
+        """
+        store_attr()
 
     def before_batch(self):
         self.orig_x, self.orig_y = self.x, self.y
 
     def before_validate(self):
-        self.embs = tensor([]).to(self.dls.device)
-        self.targs = tensor([]).to(self.dls.device)
+        try:    n = len(self.dl.dataset)
+        except (AttributeError, TypeError): n = 1024
+        self.val_bank = EmbeddingBank(n, device=self.dls.device)
 
     def after_pred(self):
-        self.embs = torch.cat([self.embs, self.model.encoder(self.orig_x)])
-        self.targs = torch.cat([self.targs, self.orig_y])
+        self.val_bank.add(self.model.encoder(self.orig_x), self.orig_y)
+
+    @torch.no_grad()
+    def _encode_bank_dl(self):
+        bank = EmbeddingBank(len(self.bank_dl.dataset), device=self.dls.device)
+        for xb,yb in self.bank_dl: bank.add(self.model.encoder(xb), yb)
+        return bank
 
     def accuracy(self):
-        self.embs = F.normalize(self.embs)
-        sim = self.embs @ self.embs.T
-        nearest_neighbor = sim.argsort(dim=1, descending=True)[:,2]
-        return (self.targs == self.targs[nearest_neighbor]).float().mean()
+        query, targs = self.val_bank.embs, self.val_bank.targs
+        if self.bank_dl is None: bank, bank_targs = query, targs
+        else:                    bank = self._encode_bank_dl(); bank, bank_targs = bank.embs, bank.targs
+        preds = knn_classify(query, bank, bank_targs, k=self.k, temp=self.temp, weighted=self.weighted,
+                             n_classes=int(max(targs.max(), bank_targs.max()))+1, chunk_size=self.chunk_size,
+                             exclude_self=self.bank_dl is None)
+        return (preds == targs).float().mean()
 
     def after_fit(self):
-        del self.embs, self.targs
+        if hasattr(self, 'val_bank'): del self.val_bank
         torch.cuda.empty_cache()
\ No newline at end of file
@@ -1,15 +1,15 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/11 - moco.ipynb (unless otherwise specified).
 
-__all__ = ['MoCoModel', 'create_moco_model', 'get_moco_aug_pipelines', 'MOCO']
+__all__ = ['MoCoModel', 'create_moco_model', 'get_moco_aug_pipelines', 'MOCO', 'DistributedMOCO']
 
 # Cell
 from fastai.vision.all import *
 from ..augmentations import *
 from ..layers import *
+from ..ema import *
 
 # Cell
 class MoCoModel(Module):
-    # TODO: Add queue as buffer to torch module, is it needed for distrib??
     "MoCo model"
     def __init__(self,encoder,projector):
         self.encoder,self.projector = encoder,projector
@@ -42,18 +42,26 @@ class MOCO(Callback):
         store_attr('K,m,temp')
 
 
+    def after_create(self): self._init_queue()
+    def _init_queue(self):
+        "Register queue in the model, so that it moves with it and is saved in checkpoints, but isn't synced by DDP"
+        if not hasattr(self.learn.model, "queue"):
+            nf = self.learn.model.projector[-1].out_features
+            self.learn.model.queue = FeatureQueue(self.K, nf).to(self.dls.device)
+        ddp_ignore_queues(self.learn.model)
+        self.feature_queue = self.learn.model.queue
+
+
     def before_fit(self):
         "Create key encoder and init queue"
-        if (not hasattr(self, "encoder_k")) and (not hasattr(self, "queue")):
+        self._init_queue()
+        if not hasattr(self, "encoder_k"):
             # init key encoder
             self.encoder_k = deepcopy(self.learn.model).to(self.dls.device)
+            del self.encoder_k.queue
             for param_k in self.encoder_k.parameters(): param_k.requires_grad = False
-            # init queue
-            nf = self.learn.model.projector[-1].out_features
-            self.queue = torch.randn(self.K, nf).to(self.dls.device)
-            self.queue = nn.functional.normalize(self.queue, dim=1)
-            self.queue_ptr = 0
-        else:warnings.warn("Key encoder and queue are already defined, keeping them.")
+            self.ema = EMA(self.learn.model, self.encoder_k)
+        else:warnings.warn("Key encoder is already defined, keeping it.")
 
         self.learn.loss_func = self.lf
 
@@ -68,24 +76,17 @@ class MOCO(Callback):
 
     def lf(self, pred, *yb):
         q,k = pred,yb[0]
-        logits = q @ torch.cat([k, self.queue]).T / self.temp # Nx(N+K) instead of original Nx(1+K)
+        logits = q @ torch.cat([k, self.feature_queue()]).T / self.temp # Nx(N+K) instead of original Nx(1+K)
         labels = torch.arange(len(q)).to(self.dls.device)
         return F.cross_entropy(logits, labels)
 
 
     @torch.no_grad()
-    def _momentum_update_key_encoder(self):
-        for param_q, param_k in zip(self.learn.model.parameters(), self.encoder_k.parameters()):
-            param_k.data = param_k.data * self.m + param_q.data * (1. - self.m)
+    def _momentum_update_key_encoder(self): self.ema.update(self.m)
 
 
     @torch.no_grad()
-    def _dequeue_and_enqueue(self):
-        bs = self.x.size(0)
-        k = self.y
-        assert self.K % bs == 0  # for simplicity
-        self.queue[self.queue_ptr:self.queue_ptr+bs, :] = k
-        self.queue_ptr = (self.queue_ptr + bs) % self.K  # move pointer
+    def _dequeue_and_enqueue(self): self.feature_queue.enqueue(self.y)
 
 
     def after_step(self):
@@ -103,4 +104,25 @@ class MOCO(Callback):
         x2 = self.aug2.decode(x2[idxs].to('cpu').clone()).clamp(0,1)
         images = []
         for i in range(n): images += [x1[i],x2[i]]
-        return show_batch(x1[0], None, images, max_n=len(images), ncols=None, nrows=n)
\ No newline at end of file
+        return show_batch(x1[0], None, images, max_n=len(images), ncols=None, nrows=n)
+
+# Cell
+from ..dist import concat_all_gather, batch_shuffle, get_rank
+
+class DistributedMOCO(MOCO):
+    "MoCo with shuffle BN and keys gathered from all processes, should be used with DistributedDataParallel"
+    def before_batch(self):
+        "Generate query and keys of the global batch with a key encoder forward on a batch shuffled across processes"
+        q_img,k_img = self.aug1(self.x), self.aug2(self.x.clone())
+        self.learn.xb = (q_img,)
+        with torch.no_grad():
+            k_img, idx_unshuffle = batch_shuffle(k_img)
+            # a single gather gives the keys of all processes, unshuffled to global batch order
+            self.learn.yb = (concat_all_gather(self.encoder_k(k_img))[idx_unshuffle],)
+
+
+    def lf(self, pred, *yb):
+        q,k = pred,yb[0]
+        logits = q @ torch.cat([k, self.feature_queue()]).T / self.temp # Nx(N*world_size+K)
+        labels = torch.arange(len(q), device=q.device) + get_rank()*len(q)
+        return F.cross_entropy(logits, labels)
\ No newline at end of file
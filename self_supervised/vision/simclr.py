@@ -1,6 +1,7 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/10 - simclr.ipynb (unless otherwise specified).
 
-__all__ = ['SimCLRModel', 'create_simclr_model', 'get_simclr_aug_pipelines', 'SimCLR', 'DistributedSimCLR']
+__all__ = ['SimCLRModel', 'create_simclr_model', 'get_simclr_aug_pipelines', 'nt_xent_loss', 'SimCLR',
+           'DistributedSimCLR']
 
 # Cell
 from fastai.vision.all import *
@@ -26,14 +27,36 @@ def create_simclr_model(encoder, hidden_size=256, projection_size=128, bn=False,
 @delegates(get_multi_aug_pipelines)
 def get_simclr_aug_pipelines(size, **kwargs): return get_multi_aug_pipelines(n=2, size=size, **kwargs)
 
+# Cell
+from torch.utils.checkpoint import checkpoint
+
+def _nt_xent_chunk(pred, keys, targ, offset, temp):
+    "Summed cross entropy of `pred` rows against `keys`, self similarities are at column `offset+row`"
+    sim = pred @ keys.T / temp
+    sim.diagonal(offset).fill_(float('-inf'))
+    return F.cross_entropy(sim, targ, reduction='sum')
+
+
+def nt_xent_loss(pred, targ, temp, all_preds=None, chunk_size=None, offset=0):
+    "NT-Xent loss of `pred` against `all_preds` (defaults to `pred`), where `pred[i]` is `all_preds[offset+i]` and `targ` indexes positives"
+    pred = F.normalize(pred, dim=1)
+    keys = pred if all_preds is None else F.normalize(all_preds, dim=1)
+    if chunk_size is None or chunk_size >= len(pred): return _nt_xent_chunk(pred, keys, targ, offset, temp) / len(pred)
+    loss = 0
+    for i in range(0, len(pred), chunk_size):
+        loss = loss + checkpoint(_nt_xent_chunk, pred[i:i+chunk_size], keys, targ[i:i+chunk_size], offset+i, temp,
+                                 use_reentrant=False)
+    return loss / len(pred)
+
 # Cell
 class SimCLR(Callback):
     order,run_valid = 9,True
-    def __init__(self, aug_pipelines, temp=0.07, print_augs=False):
+    def __init__(self, aug_pipelines, temp=0.07, print_augs=False, memory_efficient=False, chunk_size=None):
         assert_aug_pipelines(aug_pipelines)
+        self.augs = aug_pipelines
         self.aug1, self.aug2 = aug_pipelines
         if print_augs: print(self.aug1), print(self.aug2)
-        store_attr('temp')
+        store_attr('temp,memory_efficient,chunk_size')
 
 
     def before_fit(self):
@@ -41,7 +64,8 @@ class SimCLR(Callback):
 
 
     def before_batch(self):
-        xi,xj = self.aug1(self.x), self.aug2(self.x)
+        if isinstance(self.augs, MultiViewAugmentation): xi,xj = self.augs(self.x)
+        else:                                            xi,xj = self.aug1(self.x), self.aug2(self.x)
         self.learn.xb = (torch.cat([xi, xj]),)
         bs = self.learn.xb[0].shape[0]
         self.learn.yb = (torch.arange(bs, device=self.dls.device).roll(bs//2),)
@@ -53,6 +77,7 @@ class SimCLR(Callback):
 
 
     def lf(self, pred, *yb):
+        if self.memory_efficient: return nt_xent_loss(pred, yb[0], self.temp, chunk_size=self.chunk_size)
         pred, targ = F.normalize(pred, dim=1), yb[0]
         sim = self._remove_diag(pred @ pred.T) / self.temp
         targ = self._remove_diag(torch.eye(targ.shape[0], device=self.dls.device)[targ]).nonzero()[:,-1]
@@ -71,15 +96,16 @@ class SimCLR(Callback):
         return show_batch(x1[0], None, images, max_n=len(images), nrows=n)
 
 # Cell
-from ..dist import GatherLayer
+from ..dist import all_gather_with_grad, get_rank
 
 class DistributedSimCLR(Callback):
     order,run_valid = 9,True
-    def __init__(self, aug_pipelines=[], temp=0.07, print_augs=False):
+    def __init__(self, aug_pipelines=[], temp=0.07, print_augs=False, memory_efficient=False, chunk_size=None):
         assert_aug_pipelines(aug_pipelines)
+        self.augs = aug_pipelines
         self.aug1, self.aug2 = aug_pipelines
         if print_augs: print(self.aug1), print(self.aug2)
-        store_attr('temp')
+        store_attr('temp,memory_efficient,chunk_size')
 
 
     def before_fit(self):
@@ -87,23 +113,16 @@ class DistributedSimCLR(Callback):
 
 
     def before_batch(self):
-        xi,xj = self.aug1(self.x), self.aug2(self.x)
+        if isinstance(self.augs, MultiViewAugmentation): xi,xj = self.augs(self.x)
+        else:                                            xi,xj = self.aug1(self.x), self.aug2(self.x)
         self.learn.xb = (torch.cat([xi, xj]),)
         bs = self.learn.xb[0].shape[0]
         self.learn.yb = (torch.arange(bs, device=self.dls.device).roll(bs//2),)
 
 
-    def _remove_diag(self, x):
-        bs = x.shape[0]
-        return x[~torch.eye(bs).bool()].reshape(bs,bs-1)
-
-
     def lf(self, pred, *yb):
-        # gather and reorder
-        all_preds = list(GatherLayer.apply(pred)); all_preds.pop(rank_distrib())
-        all_preds = torch.cat([pred]+all_preds)
-
-        pred, all_preds, targ = F.normalize(pred, dim=1), F.normalize(all_preds, dim=1), yb[0]
-        sim = self._remove_diag(pred @ all_preds.T) / self.temp
-        targ = self._remove_diag(torch.eye(targ.shape[0], device=self.dls.device)[targ]).nonzero()[:,-1]
-        return F.cross_entropy(sim, targ)
\ No newline at end of file
+        # predictions of all processes in rank order, local predictions start at `offset`
+        all_preds = all_gather_with_grad(pred)
+        offset = get_rank()*len(pred)
+        chunk_size = self.chunk_size if self.memory_efficient else None
+        return nt_xent_loss(pred, yb[0]+offset, self.temp, all_preds, chunk_size, offset)
\ No newline at end of file
@@ -1,6 +1,6 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/13 - swav.ipynb (unless otherwise specified).
 
-__all__ = ['SwAVModel', 'create_swav_model', 'get_swav_aug_pipelines', 'SWAV']
+__all__ = ['SwAVModel', 'create_swav_model', 'sinkhorn_knopp', 'get_swav_aug_pipelines', 'SWAV', 'DistributedSWAV']
 
 # Cell
 from fastai.vision.all import *
@@ -9,8 +9,8 @@ from ..layers import *
 
 # Cell
 class SwAVModel(Module):
-    def __init__(self,encoder,projector,prototypes):
-        self.encoder,self.projector,self.prototypes = encoder,projector,prototypes
+    def __init__(self,encoder,projector,prototypes,packed=False):
+        self.encoder,self.projector,self.prototypes,self.packed = encoder,projector,prototypes,packed
 
     def forward(self, inputs):
 
@@ -20,18 +20,22 @@ class SwAVModel(Module):
                                 torch.tensor([inp.shape[-1] for inp in inputs]),
                                 return_counts=True)[1], 0)
 
-        start_idx = 0
-        for idx in crop_idxs:
-            _z = self.encoder(torch.cat(inputs[start_idx: idx]))
-            if not start_idx: z = _z
-            else:             z = torch.cat((z, _z))
-            start_idx = idx
+        if self.packed:
+            # one pass of a `VisionTransformer` encoder over the tokens of all resolutions
+            z = self.encoder.forward_packed([torch.cat(inputs[s:e]) for s,e in zip([0]+crop_idxs[:-1].tolist(), crop_idxs)])
+        else:
+            start_idx, offset = 0, 0
+            for idx in crop_idxs:
+                _z = self.encoder(torch.cat(inputs[start_idx: idx]))
+                if not start_idx: z = _z.new_empty((sum(len(inp) for inp in inputs), *_z.shape[1:]))
+                z[offset:offset+len(_z)] = _z
+                start_idx, offset = idx, offset+len(_z)
 
         z = F.normalize(self.projector(z))
         return z, self.prototypes(z)
 
 # Cell
-def create_swav_model(encoder, hidden_size=256, projection_size=128, n_protos=3000, bn=True, nlayers=2):
+def create_swav_model(encoder, hidden_size=256, projection_size=128, n_protos=3000, bn=True, nlayers=2, packed=False):
     "Create SwAV model"
     n_in  = in_channels(encoder)
     with torch.no_grad(): representation = encoder(torch.randn((2,n_in,128,128)))
@@ -41,11 +45,55 @@ def create_swav_model(encoder, hidden_size=256, projection_size=128, n_protos=30
     with torch.no_grad():
         w = prototypes.weight.data.clone()
         prototypes.weight.copy_(F.normalize(w))
-    return SwAVModel(encoder, projector, prototypes)
+    return SwAVModel(encoder, projector, prototypes, packed=packed)
+
+# Cell
+from ..dist import get_world_size, all_reduce
+
+# Cell
+def _sample_sum(Q, dims, distributed):
+    "Sum over `dims` which include the sample dim, over the samples of all processes if `distributed`"
+    s = Q.sum(dims, keepdim=True)
+    return all_reduce(s) if distributed else s
+
+
+def _sample_logsumexp(Q, dims, distributed):
+    "Logsumexp over `dims` which include the sample dim, over the samples of all processes if `distributed`"
+    if not distributed: return Q.logsumexp(dims, keepdim=True)
+    m = all_reduce(Q.amax(dims, keepdim=True), 'max')
+    return _sample_sum((Q - m).exp(), dims, True).log_().add_(m)
+
+
+@torch.no_grad()
+def sinkhorn_knopp(scores, eps=0.05, n_iters=3, log_domain=False, tol=None, distributed=False):
+    "Batched Sinkhorn-Knopp codes of `scores` (..., n_samples, n_prototypes), rows of the result sum to 1"
+    # works on (samples, prototypes) directly and in place, prototype sums are over dim -2 and sample sums over dim -1
+    Q = scores.float() / eps
+    B, K = Q.shape[-2:]
+    if distributed: B *= get_world_size()
+    if log_domain:
+        Q -= _sample_logsumexp(Q, (-2, -1), distributed)
+        for it in range(n_iters):
+            protos = _sample_logsumexp(Q, -2, distributed)
+            if tol is not None and it > 0 and ((protos + math.log(K)).exp() - 1).abs().max() < tol: break
+            Q -= protos + math.log(K)
+            Q -= Q.logsumexp(-1, keepdim=True) + math.log(B)
+        return Q.sub_(Q.logsumexp(-1, keepdim=True)).exp_()
+
+    m = Q.amax((-2, -1), keepdim=True)
+    Q = Q.sub_(all_reduce(m, 'max') if distributed else m).exp_()
+    Q /= _sample_sum(Q, (-2, -1), distributed)
+    for it in range(n_iters):
+        protos = _sample_sum(Q, -2, distributed)
+        if tol is not None and it > 0 and (protos*K - 1).abs().max() < tol: break
+        Q /= protos*K
+        Q /= Q.sum(-1, keepdim=True)*B
+    return Q.div_(Q.sum(-1, keepdim=True))
 
 # Cell
 @delegates(get_multi_aug_pipelines, but=['n', 'size', 'resize_scale'])
-def get_swav_aug_pipelines(num_crops=(2,6), crop_sizes=(224,96), min_scales=(0.25,0.05), max_scales=(1.,0.14), **kwargs):
+def get_swav_aug_pipelines(num_crops=(2,6), crop_sizes=(224,96), min_scales=(0.25,0.05), max_scales=(1.,0.14), vectorized=False, **kwargs):
+    if vectorized: return MultiViewAugmentation(num_crops, crop_sizes, min_scales, max_scales, **kwargs)
     aug_pipelines = []
     for nc, size, mins, maxs in zip(num_crops, crop_sizes, min_scales, max_scales):
         aug_pipelines += get_multi_aug_pipelines(n=nc, size=size, resize_scale=(mins,maxs), **kwargs)
@@ -56,9 +104,9 @@ class SWAV(Callback):
     order,run_valid = 9,True
     def __init__(self, aug_pipelines, crop_assgn_ids,
                        K=3000, queue_start_pct=0.25, temp=0.1,
-                       eps=0.05,  n_sinkh_iter=3, print_augs=False):
+                       eps=0.05,  n_sinkh_iter=3, log_domain=False, tol=None, print_augs=False):
 
-        store_attr('K,queue_start_pct,crop_assgn_ids,temp,eps,n_sinkh_iter')
+        store_attr('K,queue_start_pct,crop_assgn_ids,temp,eps,n_sinkh_iter,log_domain,tol')
         self.augs = aug_pipelines
         if print_augs:
             for aug in self.augs: print(aug)
@@ -66,73 +114,47 @@ class SWAV(Callback):
 
     def before_fit(self):
         self.learn.loss_func = self.lf
+        self._init_queue()
+
 
-        # init queue
-        if self.K is not None:
+    def after_create(self): self._init_queue()
+    def _init_queue(self):
+        "Register queue in the model, so that it moves with it and is saved in checkpoints, but isn't synced by DDP"
+        if self.K is None: return
+        if not hasattr(self.learn.model, "queue"):
             nf = self.learn.model.projector[-1].out_features
-            self.queue = torch.randn(self.K, nf).to(self.dls.device)
-            self.queue = nn.functional.normalize(self.queue, dim=1)
-            self.queue_ptr = 0
+            self.learn.model.queue = FeatureQueue(self.K, nf).to(self.dls.device)
+        ddp_ignore_queues(self.learn.model)
+        self.feature_queue = self.learn.model.queue
 
 
     def before_batch(self):
         "Compute multi crop inputs"
         self.bs = self.x.size(0)
-        self.learn.xb = ([aug(self.x) for aug in self.augs],)
+        if isinstance(self.augs, MultiViewAugmentation): self.learn.xb = (self.augs(self.x),)
+        else:                                            self.learn.xb = ([aug(self.x) for aug in self.augs],)
 
 
     def after_batch(self):
         with torch.no_grad():
-            w = self.learn.model.prototypes.weight.data.clone()
-            self.learn.model.prototypes.weight.data.copy_(F.normalize(w))
+            prototypes = get_model(self.learn.model).prototypes
+            prototypes.weight.data.copy_(F.normalize(prototypes.weight.data))
 
 
     @torch.no_grad()
-    def sinkhorn_knopp(self, Q, nmb_iters, device=default_device):
-        "https://en.wikipedia.org/wiki/Sinkhorn%27s_theorem#Sinkhorn-Knopp_algorithm"
-        sum_Q = torch.sum(Q)
-        Q /= sum_Q
-
-        r = (torch.ones(Q.shape[0]) / Q.shape[0]).to(device)
-        c = (torch.ones(Q.shape[1]) / Q.shape[1]).to(device)
-
-        curr_sum = torch.sum(Q, dim=1)
-
-        for it in range(nmb_iters):
-            u = curr_sum
-            Q *= (r / u).unsqueeze(1)
-            Q *= (c / torch.sum(Q, dim=0)).unsqueeze(0)
-            curr_sum = torch.sum(Q, dim=1)
-        return (Q / torch.sum(Q, dim=0, keepdim=True)).t().float()
-
-
-    @torch.no_grad()
-    def _dequeue_and_enqueue(self, embedding):
-        assert self.K % self.bs == 0  # for simplicity
-        self.queue[self.queue_ptr:self.queue_ptr+self.bs, :] = embedding
-        self.queue_ptr = (self.queue_ptr + self.bs) % self.K  # move pointer
+    def _dequeue_and_enqueue(self, embedding): self.feature_queue.enqueue(embedding)
 
 
     @torch.no_grad()
     def _compute_codes(self, output):
-        qs = []
-        for i in self.crop_assgn_ids:
-            # use queue
-            if (self.K is not None) and (self.learn.pct_train > self.queue_start_pct):
-                target_b = output[self.bs*i:self.bs*(i+1)]
-                queue_b = self.learn.model.prototypes(self.queue)
-                merged_b = torch.cat([target_b, queue_b])
-                q = torch.exp(merged_b/self.eps).t()
-                q = self.sinkhorn_knopp(q, self.n_sinkh_iter, q.device)
-                qs.append(q[:self.bs])
-
-            # don't use queue
-            else:
-                target_b = output[self.bs*i:self.bs*(i+1)]
-                q = torch.exp(target_b/self.eps).t()
-                q = self.sinkhorn_knopp(q, self.n_sinkh_iter, q.device)
-                qs.append(q)
-        return qs
+        "Codes of all assignment crops, solved together and with the queue projected once"
+        scores = torch.stack([output[self.bs*i:self.bs*(i+1)] for i in self.crop_assgn_ids])
+        # use queue
+        if (self.K is not None) and (self.learn.pct_train > self.queue_start_pct):
+            queue_scores = get_model(self.learn.model).prototypes(self.feature_queue())
+            scores = torch.cat([scores, queue_scores.expand(len(scores), -1, -1)], dim=1)
+        qs = sinkhorn_knopp(scores, self.eps, self.n_sinkh_iter, self.log_domain, self.tol)
+        return qs[:, :self.bs]
 
 
     def after_pred(self):
@@ -147,21 +169,18 @@ class SWAV(Callback):
         # Compute codes
         qs = self._compute_codes(output)
 
-        # Compute predictions
-        log_ps = []
-        for v in np.arange(len(self.augs)):
-            log_p = F.log_softmax(output[self.bs*v:self.bs*(v+1)] / self.temp, dim=1)
-            log_ps.append(log_p)
-
-        log_ps, qs = torch.stack(log_ps), torch.stack(qs)
+        # Compute predictions of all crops, (n_crops, bs, n_protos)
+        log_ps = F.log_softmax(output.view(-1, self.bs, output.size(-1)) / self.temp, dim=-1)
         self.learn.pred, self.learn.yb = log_ps, (qs,)
 
 
     def lf(self, pred, *yb):
-        log_ps, qs, loss = pred, yb[0], 0
-        t = (qs.unsqueeze(1)*log_ps.unsqueeze(0)).sum(-1).mean(-1)
-        for i, ti in enumerate(t): loss -= (ti.sum() - ti[i])/(len(ti)-1)/len(t)
-        return loss
+        "Swapped prediction loss of the codes of each assignment crop against the predictions of all other crops"
+        log_ps, qs = pred, yb[0]
+        n_crops, bs = log_ps.shape[:2]
+        # t[i,v] = mean cross entropy of codes of assignment crop i and predictions of crop v
+        t = qs.reshape(len(qs), -1) @ log_ps.reshape(n_crops, -1).t() / bs
+        return -((t.sum(1) - t.diagonal()) / (n_crops-1)).mean()
 
     @torch.no_grad()
     def show(self, n=1):
@@ -170,4 +189,27 @@ class SWAV(Callback):
         images = [aug.decode(xb.to('cpu').clone()).clamp(0, 1)[i]
                   for i in idxs
                   for xb, aug in zip(xbs, self.augs)]
-        return show_batch(images[0], None, images, max_n=len(images), nrows=n)
\ No newline at end of file
+        return show_batch(images[0], None, images, max_n=len(images), nrows=n)
+
+# Cell
+from ..dist import get_rank
+
+class DistributedSWAV(SWAV):
+    "SwAV with codes solved over the global batch and a queue shared by all processes"
+    def _init_queue(self):
+        super()._init_queue()
+        if self.K is None: return
+        assert self.K % get_world_size() == 0, "K needs to be a multiple of the number of processes"
+        self.feature_queue.gather = True
+
+
+    @torch.no_grad()
+    def _compute_codes(self, output):
+        "Codes of the global batch, each process adds its own part of the shared queue"
+        scores = torch.stack([output[self.bs*i:self.bs*(i+1)] for i in self.crop_assgn_ids])
+        if (self.K is not None) and (self.learn.pct_train > self.queue_start_pct):
+            queue = self.feature_queue().chunk(get_world_size())[get_rank()]
+            queue_scores = get_model(self.learn.model).prototypes(queue)
+            scores = torch.cat([scores, queue_scores.expand(len(scores), -1, -1)], dim=1)
+        qs = sinkhorn_knopp(scores, self.eps, self.n_sinkh_iter, self.log_domain, self.tol, distributed=True)
+        return qs[:, :self.bs]
\ No newline at end of file